@@ -0,0 +1,224 @@
+#Copyright 2012, 2013 R. David Murray (see end comment for terms).
+"""Microbenchmarks for the dinsd relational operators.
+
+Times each of the relational operators on synthetic relations, and measures
+the peak memory it allocates, then prints the results as JSON, or compares
+them with a baseline saved by an earlier run:
+
+    python3 bench/core_bench.py [-r ROWS] [-d DISTINCT] [-S SELECTIVITY]
+                                [-k TYPE] [-n REPEAT] [-b BENCH ...]
+                                [--save FILE] [--baseline FILE]
+                                [--threshold RATIO]
+
+The data is generated from a fixed seed, so every run with the same
+parameters works on the same relations:
+
+    big             ROWS rows of (id, k, v, payload): id is unique, k has
+                    DISTINCT different values of type TYPE (int, str, or
+                    float), v is an int between 0 and 99, and payload is a
+                    short str.
+    small           The DISTINCT rows of (k, w), one for each value of k,
+                    used as the other operand of the binary operators.
+    half            The rows of small with half of the values of k.
+    overlap         ROWS rows of the same type as big, half of them in big.
+
+where predicates select the rows of big whose v is below SELECTIVITY * 100.
+
+With --save the results are written to FILE as a baseline.  With --baseline
+each result is shown next to the baseline's, and the exit status is 1 if any
+benchmark took more than RATIO (by default 1.25) times as long as it did in
+the baseline, or allocated more than RATIO times as much memory.  Only
+compare runs made with the same parameters on the same machine.
+
+"""
+
+import argparse
+import gc
+import json
+import platform
+import random
+import sys
+import time
+import tracemalloc
+
+import dinsd
+from dinsd import rel, join, matching, notmatching, union
+
+_types = {'int': int, 'str': str, 'float': float}
+
+
+def values(typename, count):
+    # count distinct values of the named type.
+    if typename == 'int':
+        return list(range(count))
+    if typename == 'float':
+        return [i / 4 for i in range(count)]
+    return ['k{:06d}'.format(i) for i in range(count)]
+
+
+class Data:
+
+    def __init__(self, rows=10000, distinct=100, selectivity=0.1,
+                 keytype='int', seed=0):
+        rand = random.Random(seed)
+        self.rows = rows
+        self.distinct = distinct
+        self.selectivity = selectivity
+        self.threshold = int(selectivity * 100)
+        ktype = _types[keytype]
+        keys = values(keytype, distinct)
+        self.Big = rel(id=int, k=ktype, v=int, payload=str)
+        self.Small = rel(k=ktype, w=int)
+        self.dicts = [dict(id=i, k=rand.choice(keys), v=rand.randrange(100),
+                           payload='p{}'.format(rand.randrange(rows)))
+                      for i in range(rows)]
+        self.big = self.Big(self.dicts)
+        self.small = self.Small(dict(k=k, w=i) for i, k in enumerate(keys))
+        self.half = self.Small(dict(k=k, w=i) for i, k in enumerate(keys)
+                                              if i % 2)
+        self.overlap = self.Big(dict(d, id=d['id'] + rows // 2)
+                                for d in self.dicts)
+
+
+def benchmarks(data):
+    """Return a dict mapping benchmark names to functions of no arguments."""
+    big, small, half = data.big, data.small, data.half
+    grouped = big.group(rest={'id', 'v', 'payload'})
+    wrapped = big.wrap(rest={'v', 'payload'})
+    threshold = data.threshold
+    return {
+        'rel': lambda: data.Big(data.dicts),
+        'join': lambda: join(big, small),
+        'binary_join': lambda: dinsd._binary_join(big, small),
+        'matching': lambda: matching(big, half),
+        'notmatching': lambda: notmatching(big, half),
+        'project': lambda: big >> {'k', 'v'},
+        'rename': lambda: big.rename(v='value'),
+        'where_str': lambda: big.where('v < {}'.format(threshold)),
+        'where_callable': lambda: big.where(lambda r: r.v < threshold),
+        'extend': lambda: big.extend(double='v * 2'),
+        'union': lambda: union(big, data.overlap),
+        'summarize': lambda: big.summarize(
+                                {'k'}, total="sum(_summary_.compute('v'))"),
+        'group': lambda: big.group(rest={'id', 'v', 'payload'}),
+        'ungroup': lambda: grouped.ungroup('rest'),
+        'wrap': lambda: big.wrap(rest={'v', 'payload'}),
+        'unwrap': lambda: wrapped.unwrap('rest'),
+        'display': lambda: big.display('id', 'k', 'v', 'payload', sort=['id']),
+        'order_by': lambda: big.order_by('v', limit=50),
+        }
+
+
+def measure(func, repeat):
+    # The best of repeat timings, and the peak memory allocated by one more
+    # call, traced separately since tracing slows everything down.
+    times = []
+    for i in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    gc.collect()
+    tracemalloc.start()
+    try:
+        func()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return dict(time=min(times), peak=peak)
+
+
+def run(data, names=None, repeat=3):
+    benches = benchmarks(data)
+    if names:
+        unknown = set(names) - benches.keys()
+        if unknown:
+            raise ValueError("unknown benchmarks: {}".format(sorted(unknown)))
+        benches = {n: benches[n] for n in names}
+    results = {name: measure(func, repeat) for name, func in benches.items()}
+    return dict(params=dict(rows=data.rows, distinct=data.distinct,
+                            selectivity=data.selectivity,
+                            keytype=data.Big.header['k'].__name__),
+                python=platform.python_version(), platform=platform.platform(),
+                time=time.strftime('%Y-%m-%dT%H:%M:%S'), results=results)
+
+
+def compare(report, baseline, threshold=1.25):
+    """Return lines comparing report with baseline, and whether any of its
+    results is worse than the baseline's by more than threshold.
+    """
+    lines = []
+    regressed = False
+    if report['params'] != baseline['params']:
+        lines.append("warning: baseline parameters differ: {}".format(
+                        baseline['params']))
+    lines.append('{:<16}{:>12}{:>12}{:>8}{:>12}{:>12}{:>8}'.format(
+                    'benchmark', 'time', 'baseline', 'ratio',
+                    'peak', 'baseline', 'ratio'))
+    for name, result in sorted(report['results'].items()):
+        base = baseline['results'].get(name)
+        if base is None:
+            lines.append('{:<16}{:>12.6f}{:>12}'.format(name, result['time'],
+                                                         'new'))
+            continue
+        tratio = result['time'] / base['time'] if base['time'] else 1.0
+        pratio = result['peak'] / base['peak'] if base['peak'] else 1.0
+        flag = ''
+        if tratio > threshold or pratio > threshold:
+            regressed = True
+            flag = '  REGRESSED'
+        lines.append('{:<16}{:>12.6f}{:>12.6f}{:>8.2f}{:>12}{:>12}{:>8.2f}{}'
+                     .format(name, result['time'], base['time'], tratio,
+                             result['peak'], base['peak'], pratio, flag))
+    return lines, regressed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('-r', '--rows', type=int, default=10000)
+    parser.add_argument('-d', '--distinct', type=int, default=100,
+                        help="number of distinct values of k")
+    parser.add_argument('-S', '--selectivity', type=float, default=0.1,
+                        help="fraction of the rows selected by where")
+    parser.add_argument('-k', '--keytype', choices=sorted(_types),
+                        default='int', help="type of k")
+    parser.add_argument('-n', '--repeat', type=int, default=3)
+    parser.add_argument('-b', '--bench', action='append',
+                        help="run only this benchmark (may be repeated)")
+    parser.add_argument('--save', help="write the results to this file")
+    parser.add_argument('--baseline', help="compare with this saved file")
+    parser.add_argument('--threshold', type=float, default=1.25)
+    args = parser.parse_args(argv)
+    data = Data(args.rows, args.distinct, args.selectivity, args.keytype)
+    report = run(data, args.bench, args.repeat)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+            f.write('\n')
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        lines, regressed = compare(report, baseline, args.threshold)
+        print('\n'.join(lines))
+        return 1 if regressed else 0
+    if not args.save:
+        print(json.dumps(report, indent=2, sort_keys=True))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
+
+
+
+#Licensed under the Apache License, Version 2.0 (the "License");
+#you may not use this file except in compliance with the License.
+#You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+#Unless required by applicable law or agreed to in writing, software
+#distributed under the License is distributed on an "AS IS" BASIS,
+#WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#See the License for the specific language governing permissions and
+#limitations under the License.
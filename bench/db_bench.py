@@ -0,0 +1,193 @@
+#Copyright 2012, 2013 R. David Murray (see end comment for terms).
+"""Benchmarks for the dinsd persistent Database back ends.
+
+Runs a fixed set of operations against a Database module (by default
+dinsd.sqlite_pickle_db) at each of several relation sizes, and prints the
+results as JSON, so that the output of runs made at different times, or
+against different back ends or options, can be compared.  Everything happens
+in a temporary directory that is removed afterward.
+
+    python3 bench/db_bench.py [-m MODULE] [-s SIZES] [-n OPS] [-t THREADS]
+                              [-O NAME=VALUE ...] [-o FILE]
+
+At each size the benchmark measures:
+
+    bulk_load       Seconds to assign a relation of that many rows to a new
+                    database.
+    open            Seconds to open the database holding it.
+    insert          Latency of inserting one row, in microseconds.
+    update          Latency of updating one row selected by its id.
+    delete          Latency of deleting one row selected by its id.
+    keyed_insert    Latency of inserting one row into the same relation with
+                    a key declared on id.
+    commit_rate     Transactions per second, each inserting a row into a
+                    small relation, so that the cost is mostly the commit.
+    read_throughput Transactions per second, across THREADS threads, each
+                    reading the relation and checking whether a row is in it.
+
+Latencies are reported as the median, 95th percentile, and mean of OPS
+operations.  Options to pass to the Database are given with -O; values are
+evaluated as Python literals if they can be (-O wal=True -O readers=8).
+
+"""
+
+import argparse
+import ast
+import importlib
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+from dinsd import rel, row
+
+Item = rel(id=int, name=str, score=int)
+Counter = rel(n=int)
+
+
+def items(size, seed=0):
+    rand = random.Random(seed)
+    r = Item()
+    r._rows = {Item.row({'id': i,
+                         'name': 'item{:08d}'.format(rand.randrange(size)),
+                         'score': rand.randrange(100)})
+               for i in range(size)}
+    return r
+
+
+def latencies(times):
+    times = sorted(t * 1e6 for t in times)
+    return dict(median=statistics.median(times),
+                p95=times[min(len(times) - 1, int(len(times) * 0.95))],
+                mean=statistics.mean(times))
+
+
+def timed(func, *args, **kw):
+    start = time.perf_counter()
+    func(*args, **kw)
+    return time.perf_counter() - start
+
+
+def bench_size(Database, options, dirname, size, ops, threads):
+    fn = os.path.join(dirname, 'bench{}.db'.format(size))
+    result = dict(size=size)
+    base = items(size)
+    rand = random.Random(size)
+
+    db = Database(fn, **options)
+    start = time.perf_counter()
+    db.r.items = base
+    result['bulk_load'] = time.perf_counter() - start
+    db.r.counter = Counter()
+    db.close()
+
+    start = time.perf_counter()
+    db = Database(fn, **options)
+    result['open'] = time.perf_counter() - start
+
+    new_ids = list(range(size, size + ops))
+    result['insert'] = latencies([
+        timed(db.r.items.insert, row(id=i, name='new', score=0))
+        for i in new_ids])
+    result['update'] = latencies([
+        timed(db.r.items.update, 'id == {}'.format(rand.randrange(size)),
+              score='score + 1')
+        for i in range(ops)])
+    result['delete'] = latencies([
+        timed(db.r.items.delete, 'id == {}'.format(i)) for i in new_ids])
+
+    db.set_key('items', {'id'})
+    result['keyed_insert'] = latencies([
+        timed(db.r.items.insert, row(id=i, name='new', score=0))
+        for i in new_ids])
+
+    start = time.perf_counter()
+    for i in range(ops):
+        with db.transaction():
+            db.r.counter.insert(row(n=i))
+    result['commit_rate'] = ops / (time.perf_counter() - start)
+
+    probes = [Item.row({'id': i, 'name': 'x', 'score': 0})
+              for i in range(ops)]
+    def reader():
+        for rw in probes:
+            with db.transaction():
+                rw in db.r.items
+    workers = [threading.Thread(target=reader) for i in range(threads)]
+    start = time.perf_counter()
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    result['read_throughput'] = threads * ops / (time.perf_counter() - start)
+    db.close()
+    return result
+
+
+def run(module, sizes, ops, threads, options):
+    Database = importlib.import_module(module).Database
+    with tempfile.TemporaryDirectory() as dirname:
+        results = [bench_size(Database, options, dirname, size, ops, threads)
+                   for size in sizes]
+    return dict(module=module, options=options, ops=ops, threads=threads,
+                python=platform.python_version(), platform=platform.platform(),
+                time=time.strftime('%Y-%m-%dT%H:%M:%S'), results=results)
+
+
+def option(text):
+    name, sep, value = text.partition('=')
+    if not sep:
+        raise argparse.ArgumentTypeError("expected NAME=VALUE")
+    try:
+        value = ast.literal_eval(value)
+    except (ValueError, SyntaxError):
+        pass
+    return name, value
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('-m', '--module', default='dinsd.sqlite_pickle_db',
+                        help="Database module to benchmark")
+    parser.add_argument('-s', '--sizes', default='1000,10000,100000',
+                        help="comma separated relation sizes")
+    parser.add_argument('-n', '--ops', type=int, default=200,
+                        help="operations per latency measurement")
+    parser.add_argument('-t', '--threads', type=int, default=4,
+                        help="reader threads")
+    parser.add_argument('-O', '--option', type=option, action='append',
+                        default=[], help="Database option NAME=VALUE")
+    parser.add_argument('-o', '--output', help="write the JSON here")
+    args = parser.parse_args(argv)
+    sizes = [int(s) for s in args.sizes.split(',')]
+    report = run(args.module, sizes, args.ops, args.threads,
+                 dict(args.option))
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
+
+
+
+#Licensed under the Apache License, Version 2.0 (the "License");
+#you may not use this file except in compliance with the License.
+#You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+#Unless required by applicable law or agreed to in writing, software
+#distributed under the License is distributed on an "AS IS" BASIS,
+#WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#See the License for the specific language governing permissions and
+#limitations under the License.
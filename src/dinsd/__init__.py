@@ -1,10 +1,15 @@
 #Copyright 2012, 2013 R. David Murray (see end comment for terms).
 
+import array as _array
 import collections as _collections
 import contextlib as _contextlib
+import functools as _functools
+import heapq as _heapq
 import itertools as _itertools
+import json as _json
 import operator as _operator
 import threading as _threading
+import time as _time
 import types as _types
 import weakref as _weakref
 
@@ -280,6 +285,42 @@ def _rel_dct(header):
     return dict(header=header, degree=len(header), row=_get_type('row', header))
 
 
+# The array typecode and numpy dtype of the columns of attributes of these
+# types.
+_column_types = {int: ('q', 'int64'), float: ('d', 'float64'),
+                 bool: ('B', 'bool')}
+
+@_functools.lru_cache(maxsize=None)
+def _numpy():
+    # numpy, or None if it isn't installed.  It is only imported when the
+    # first column is made, since importing it takes longer than importing
+    # all of dinsd.
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+def _column(typ, values):
+    # Return the list values as a read-only buffer if they are of a type that
+    # can be stored in one, and otherwise as a tuple.
+    codes = _column_types.get(typ)
+    if codes is None:
+        return tuple(values)
+    numpy = _numpy()
+    try:
+        if numpy is not None:
+            col = numpy.array(values, dtype=codes[1])
+            col.flags.writeable = False
+            return col
+        col = memoryview(_array.array(codes[0], values))
+    except OverflowError:
+        return tuple(values)
+    if typ is bool:
+        col = col.cast('?')
+    return col.toreadonly()
+
+
 def _rel(attrdict):
     # For internal use we don't need to do all those checks above.
     return _get_type('rel', attrdict)
@@ -389,6 +430,59 @@ class _Relation(_RichCompareMixin):
     def __len__(self):
         return len(self._rows)
 
+    def __contains__(self, row):
+        try:
+            return row in self._rows
+        except TypeError:
+            # Unhashable, and therefore not a row.
+            return False
+
+    # Column access.
+
+    # (body, its length, its rows in column order, {attrname: column}).
+    _columns_ = None
+
+    def column(self, attrname):
+        """Return the values of attrname, one for each row.
+
+        See columns.
+        """
+        return self.columns(attrname)[0]
+
+    def columns(self, *attrnames):
+        """Return a tuple of the columns of values of attrnames (by default
+        all of the attributes, in name order).
+
+        Each column holds one value for each row, and the rows are in the same
+        order in every column of the relation.  The columns of int, float, and
+        bool attributes are read-only numpy arrays if numpy is available, and
+        otherwise read-only memoryviews of arrays, which numpy and other
+        consumers of the buffer protocol can use without copying them.  Other
+        columns (and int columns with values too big for a C long long) are
+        tuples.  Since a relation's body never changes, the columns are made
+        only once.
+        """
+        if not attrnames:
+            attrnames = sorted(self.header)
+        self._validate_attr_names(attrnames)
+        rows = self._rows
+        cache = self._columns_
+        if cache is None or cache[0] is not rows or cache[1] != len(rows):
+            cache = self._columns_ = (rows, len(rows), tuple(rows), {})
+        made = cache[3]
+        result = []
+        for name in attrnames:
+            col = made.get(name)
+            if col is None:
+                col = made[name] = _column(
+                    self.header[name],
+                    list(map(_operator.attrgetter(name), cache[2])))
+            result.append(col)
+        return tuple(result)
+
+    # (body, its length, {ordering attribute names: rows in that order}).
+    _orders_ = None
+
     # Comparison operators (see RichCompareMixin).
 
     def _cmpkey(self):
@@ -477,6 +571,9 @@ class _Relation(_RichCompareMixin):
     def display(self, *args, **kw):
         return display(self, *args, **kw)
 
+    def order_by(self, attrnames, descending=False, limit=None, offset=0):
+        return order_by(self, attrnames, descending, limit, offset)
+
     def __str__(self):
         return _display(self, *sorted(self.header))
 
@@ -519,10 +616,26 @@ def _get_type(typetype, header):
 #
 
 
+# The operators record their calls in the active profile, if there is one
+# (see profile, below).  When there isn't, all this costs is a function call
+# and a test per operator call.
+_active_profile = None
+
+def _profiled(func):
+    name = func.__name__
+    @_functools.wraps(func)
+    def profiled_wrapper(*args, **kw):
+        if _active_profile is None:
+            return func(*args, **kw)
+        return _active_profile._call(name, func, args, kw)
+    return profiled_wrapper
+
+
 Dum = rel()
 Dee = rel(row())
 
 
+@_profiled
 def join(*relations):
     if not relations:
         return Dee
@@ -539,6 +652,7 @@ def join(*relations):
     return joined
 
 
+@_profiled
 def _binary_join(first, second):
     combined_attrs = first.header.copy()
     common_attrs = []
@@ -580,6 +694,7 @@ def _binary_join(first, second):
     return new_rel
 
 
+@_profiled
 def intersect(*relations):
     if not relations:
         return Dee
@@ -596,6 +711,7 @@ def intersect(*relations):
     return new_rel
 
 
+@_profiled
 def times(*relations):
     if not relations:
         return Dee
@@ -609,6 +725,7 @@ def times(*relations):
     return join(first, *relations)
 
 
+@_profiled
 def rename(relation, **renames):
     new_attrs = relation.header.copy()
     holder = {}
@@ -647,6 +764,7 @@ class all_but:
         return all_names - self.names
 
 
+@_profiled
 def project(relation, attr_names):
     if hasattr(attr_names, 'all_but'):
         attr_names = attr_names.all_but(relation)
@@ -664,6 +782,7 @@ def project(relation, attr_names):
     return new_rel
 
 
+@_profiled
 def where(relation, condition):
     if isinstance(condition, str):
         c = compile(condition, '<where>', 'eval')
@@ -675,6 +794,7 @@ def where(relation, condition):
     return new_rel
 
 
+@_profiled
 def extend(relation, *args, **new_attrs):
     if len(args) > 1:
         raise TypeError("extend() takes at most one positional argument but"
@@ -709,6 +829,7 @@ def extend(relation, *args, **new_attrs):
     return new_rel
 
 
+@_profiled
 def union(*relations):
     if len(relations) == 0:
         return Dum
@@ -762,20 +883,24 @@ def _matcher(first, second, match):
     return new_rel
 
 
+@_profiled
 def notmatching(first, second):
     return _matcher(first, second, match=False)
 
 
+@_profiled
 def minus(first, second):
     if not first.header == second.header:
         raise TypeError("Relation types must match for minus operation")
     return notmatching(first, second)
 
 
+@_profiled
 def matching(first, second):
     return _matcher(first, second, match=True)
 
 
+@_profiled
 def compose(first, second):
     common_attrs = _common_attrs(first, second)
     return project(join(first, second), all_but(common_attrs))
@@ -787,6 +912,7 @@ def compose(first, second):
 #
 
 
+@_profiled
 def display(relation, *columns, **kw):
     relation._validate_attr_list(columns)
     return _display(relation, *columns, **kw)
@@ -863,6 +989,79 @@ def _tline(parts, widths):
 
 
 
+#
+# Ordering
+#
+
+
+# order_by picks out the rows it returns with a heap when they come from no
+# more than the first 1/_HEAP_FRACTION of the ordered rows, and otherwise
+# sorts all of the rows, keeping the sorted list as an index that later calls
+# on the same relation can slice.
+_HEAP_FRACTION = 16
+
+
+@_profiled
+def order_by(relation, attrnames, descending=False, limit=None, offset=0):
+    """Return a list of the rows of relation ordered by attrnames.
+
+    attrnames is a name or a list of names, most significant first.  Rows
+    with the same values for those are ordered by the rest of their
+    attributes, in name order, so the order is always the same.  The first
+    offset rows are skipped, and at most limit rows (by default all the rest)
+    are returned.
+    """
+    names, stop = _order_args(relation, attrnames, limit, offset)
+    if offset >= stop:
+        return []
+    key = _order_key(names)
+    rows = relation._rows
+    n = len(rows)
+    cache = relation._orders_
+    if cache is None or cache[0] is not rows or cache[1] != n:
+        cache = relation._orders_ = (rows, n, {})
+    index = cache[2].get(names)
+    if index is None:
+        if stop * _HEAP_FRACTION <= n:
+            return _top(rows, key, descending, stop)[offset:]
+        index = cache[2][names] = sorted(rows, key=key)
+    if descending:
+        return index[n-stop:n-offset][::-1]
+    return index[offset:stop]
+
+
+def _order_args(relation, attrnames, limit, offset):
+    # Check order_by's arguments, and return the names of all the attributes
+    # in the order the rows are ordered by them, and the position in the
+    # ordered rows just after the last row to return.
+    if isinstance(attrnames, str):
+        attrnames = [attrnames]
+    relation._validate_attr_names(attrnames)
+    if offset < 0:
+        raise ValueError("offset must not be negative, not {}".format(offset))
+    if limit is not None and limit < 0:
+        raise ValueError("limit must not be negative, not {}".format(limit))
+    names = list(attrnames)
+    names.extend(n for n in sorted(relation.header) if n not in names)
+    n = len(relation)
+    stop = n if limit is None else min(n, offset + limit)
+    return tuple(names), stop
+
+
+def _order_key(names):
+    if not names:
+        return lambda row: ()
+    return _operator.attrgetter(*names)
+
+
+def _top(rows, key, descending, count):
+    # The first count of rows in order.
+    if descending:
+        return _heapq.nlargest(count, rows, key=key)
+    return _heapq.nsmallest(count, rows, key=key)
+
+
+
 #
 # Aggregate Operators
 #
@@ -897,6 +1096,7 @@ def avg(iterator):
 #
 
 
+@_profiled
 def summarize(relation, comprel, _debug_=False, **new_attrs):
     if not hasattr(comprel, 'header'):
         # Assume it is an attribute name list
@@ -908,6 +1108,7 @@ def summarize(relation, comprel, _debug_=False, **new_attrs):
     return extend(x, **new_attrs) << {'_summary_'}
 
 
+@_profiled
 def group(relation, **kw):
     if len(kw) > 1:
         raise TypeError("Only one new attribute may be specified for group")
@@ -917,6 +1118,7 @@ def group(relation, **kw):
     return extend(grouped, **{name: grouping_func})
 
 
+@_profiled
 def ungroup(relation, attrname):
     if not(relation):
         raise ValueError("Cannot ungroup an empty relation")
@@ -934,6 +1136,7 @@ def ungroup(relation, attrname):
     return new_rel
 
     
+@_profiled
 def wrap(relation, **kw):
     if len(kw) > 1:
         raise TypeError("Only one new attribute may be specified for wrap")
@@ -945,6 +1148,7 @@ def wrap(relation, **kw):
     return extend(relation, **{name: row_func}) << attr_names
 
 
+@_profiled
 def unwrap(relation, attrname):
     if not(relation):
         raise ValueError("Cannot unwrap an empty relation")
@@ -969,6 +1173,134 @@ def extract_only_row(relation):
 
 
 
+#
+# Profiling
+#
+
+
+class profile:
+
+    """Record the relational operator calls made inside a with statement.
+
+        with dinsd.profile() as p:
+            ...
+        print(p.tree())
+
+    Each call made by the thread that entered the with statement is recorded
+    as a ProfileCall, holding the calls the operator itself made.  Only one
+    profile can be active at a time.  While it is, the hashing of rows and
+    the evaluation of expressions on them are instrumented in every thread,
+    which slows them a little, although only the profiling thread's are
+    counted.
+    """
+
+    def __init__(self):
+        self.calls = []
+        self._stack = []
+        self.hashed = self.evaluations = 0
+
+    def __enter__(self):
+        global _active_profile
+        if _active_profile is not None:
+            raise RuntimeError("a profile is already active")
+        self._thread = _threading.current_thread()
+        self._hash = _Row.__hash__
+        self._as_locals = _Row._as_locals
+        # Counting hashes and expression evaluations costs something for
+        # every row, so it is only done while profiling.  The methods are
+        # replaced for every thread, but only the profiling thread's calls
+        # are counted.
+        ident = _threading.get_ident()
+        def __hash__(row):
+            if _threading.get_ident() == ident:
+                self.hashed += 1
+            return self._hash(row)
+        def _as_locals(row):
+            if _threading.get_ident() == ident:
+                self.evaluations += 1
+            return self._as_locals(row)
+        _Row.__hash__ = __hash__
+        _Row._as_locals = _as_locals
+        _active_profile = self
+        return self
+
+    def __exit__(self, *args):
+        global _active_profile
+        _active_profile = None
+        _Row.__hash__ = self._hash
+        _Row._as_locals = self._as_locals
+
+    def _call(self, name, func, args, kw):
+        if _threading.current_thread() is not self._thread:
+            return func(*args, **kw)
+        call = ProfileCall(name, [len(a) for a in args
+                                  if hasattr(a, 'header') and
+                                     not isinstance(a, type)])
+        (self._stack[-1].calls if self._stack else self.calls).append(call)
+        self._stack.append(call)
+        hashed, evaluations = self.hashed, self.evaluations
+        start = _time.perf_counter()
+        try:
+            result = func(*args, **kw)
+        finally:
+            call.time = _time.perf_counter() - start
+            call.hashed = self.hashed - hashed
+            call.evaluations = self.evaluations - evaluations
+            self._stack.pop()
+        if hasattr(result, 'header') and not isinstance(result, type):
+            call.output = len(result)
+        return result
+
+    def tree(self):
+        """Return the calls as an indented tree, one call per line."""
+        lines = []
+        def add(calls, depth):
+            for c in calls:
+                lines.append('{}{}'.format('  ' * depth, c))
+                add(c.calls, depth + 1)
+        add(self.calls, 0)
+        return '\n'.join(lines)
+
+    def as_dict(self):
+        return {'calls': [c.as_dict() for c in self.calls]}
+
+    def to_json(self, **kw):
+        """Return the calls as JSON; kw is passed to json.dumps."""
+        return _json.dumps(self.as_dict(), **kw)
+
+    def __str__(self):
+        return self.tree()
+
+
+class ProfileCall:
+
+    """One call of an operator: its name, the cardinalities of the relations
+    it was passed (inputs) and returned (output, None if it didn't return a
+    relation), the wall clock seconds it took, how many times rows were hashed
+    and how many expressions were evaluated on rows during it (both including
+    those done by the calls it made), and those calls.
+    """
+
+    output = None
+
+    def __init__(self, name, inputs):
+        self.name = name
+        self.inputs = inputs
+        self.calls = []
+
+    def as_dict(self):
+        return dict(name=self.name, inputs=self.inputs, output=self.output,
+                    time=self.time, hashed=self.hashed,
+                    evaluations=self.evaluations,
+                    calls=[c.as_dict() for c in self.calls])
+
+    def __str__(self):
+        return '{} {:.6f}s in={} out={} hashed={} evaluations={}'.format(
+                    self.name, self.time, self.inputs, self.output,
+                    self.hashed, self.evaluations)
+
+
+
 #
 # Namespace management
 #
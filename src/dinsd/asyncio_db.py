@@ -0,0 +1,202 @@
+#Copyright 2012, 2013 R. David Murray (see end comment for terms).
+"""An asyncio interface to a sqlite_pickle_db Database.
+
+A Database keeps the state of each thread's transactions in thread-local
+storage, so a transaction has to be run from start to finish in one thread,
+and a coroutine can't simply call the Database: it would block the event loop,
+and any other coroutine running on the loop would share its transaction.  An
+AsyncDatabase runs all the work in threads instead, and makes it awaitable:
+
+    work inside a transaction
+                    runs in a thread dedicated to that transaction (and any
+                    transactions nested in it), so the transaction sees its
+                    own snapshot and changes no matter how many other tasks
+                    are running transactions at the same time.  Which
+                    transaction a task is in is tracked with a context
+                    variable, so it is carried across awaits, and shared by
+                    tasks the transaction's task creates.
+    writes outside a transaction
+                    run, each in a transaction of its own, in a single writer
+                    thread.
+    queries outside a transaction
+                    run in a pool of reader threads, since outside a
+                    transaction a Database can be read from any number of
+                    threads at once.
+
+"""
+
+import asyncio as _asyncio
+import concurrent.futures as _futures
+import contextvars as _contextvars
+from dinsd import expression_namespace as _expns
+from dinsd.sqlite_pickle_db import Database as _Database
+
+
+class AsyncDatabase:
+
+    def __init__(self, db, readers=4):
+        self.db = db
+        self._readers = _futures.ThreadPoolExecutor(readers)
+        self._writer = _futures.ThreadPoolExecutor(1)
+        # Threads for transactions, kept for reuse once their transaction is
+        # done.
+        self._idle = []
+        self._worker = _contextvars.ContextVar('dinsd_transaction_thread',
+                                               default=None)
+
+    @classmethod
+    async def open(cls, fn, readers=4, **kw):
+        """Open the Database fn (with Database arguments kw) in a thread."""
+        loop = _asyncio.get_running_loop()
+        db = await loop.run_in_executor(None, lambda: _Database(fn, **kw))
+        return cls(db, readers=readers)
+
+    def _call(self, executor, func, *args, **kw):
+        return _asyncio.wrap_future(executor.submit(func, *args, **kw))
+
+    def _read(self, func, *args, **kw):
+        worker = self._worker.get()
+        return self._call(self._readers if worker is None else worker,
+                          func, *args, **kw)
+
+    def _write(self, func, *args, **kw):
+        worker = self._worker.get()
+        return self._call(self._writer if worker is None else worker,
+                          func, *args, **kw)
+
+    def _take_worker(self):
+        if self._idle:
+            return self._idle.pop()
+        return _futures.ThreadPoolExecutor(1)
+
+    def _release_worker(self, worker):
+        self._idle.append(worker)
+
+    @property
+    def transactions(self):
+        """True if the current task is in a transaction."""
+        return self._worker.get() is not None
+
+    def transaction(self):
+        return _AsyncTransaction(self)
+
+    async def run_transaction(self, func, *args, retries=10, **kw):
+        """Run Database.run_transaction(func, *args, **kw) in a thread.
+
+        func is an ordinary function, which is called (perhaps more than
+        once) in the thread.
+        """
+        worker = self._worker.get()
+        if worker is not None:
+            return await self._call(worker, self.db.run_transaction, func,
+                                    *args, retries=retries, **kw)
+        worker = self._take_worker()
+        try:
+            return await self._call(worker, self.db.run_transaction, func,
+                                    *args, retries=retries, **kw)
+        finally:
+            self._release_worker(worker)
+
+    async def run(self, func, *args, **kw):
+        """Call func(*args, **kw) in the current transaction's thread.
+
+        Outside a transaction func is called in the writer thread.
+        """
+        return await self._write(func, *args, **kw)
+
+    async def query(self, expr):
+        """Return the value of the expression string expr.
+
+        The names in the expression are looked up in the database, as seen
+        by the current transaction if there is one, and then in the current
+        dinsd namespace.
+        """
+        code = compile(expr, '<query>', 'eval')
+        return await self._read(
+                lambda: eval(code, _expns, self.db._as_locals()))
+
+    async def get(self, relname):
+        return await self._read(lambda: self.db[relname])
+
+    async def set(self, relname, value):
+        await self._write(self.db.__setitem__, relname, value)
+
+    async def insert(self, relname, rows):
+        await self._write(lambda: self.db[relname].insert(rows))
+
+    async def update(self, relname, condition, **kw):
+        await self._write(lambda: self.db[relname].update(condition, **kw))
+
+    async def delete(self, relname, condition):
+        await self._write(lambda: self.db[relname].delete(condition))
+
+    async def close(self):
+        await self._call(self._writer, self.db.close)
+        for executor in [self._readers, self._writer] + self._idle:
+            executor.shutdown(wait=False)
+        self._idle = []
+
+
+def _end_if_entered(entered, cm, exc):
+    # Run in the worker after the cm.__enter__ call whose future is entered.
+    if not entered.cancelled() and entered.exception() is None:
+        cm.__exit__(type(exc), exc, exc.__traceback__)
+
+
+class _AsyncTransaction:
+
+    def __init__(self, adb):
+        self.adb = adb
+
+    async def __aenter__(self):
+        adb = self.adb
+        self.outer = adb._worker.get()
+        worker = self.outer or adb._take_worker()
+        cm = adb.db.transaction()
+        entered = worker.submit(cm.__enter__)
+        try:
+            await _asyncio.wrap_future(entered)
+        except _asyncio.CancelledError as exc:
+            # cm.__enter__ may already be running in the worker, and so may
+            # yet begin the transaction.  Once it is done, the transaction has
+            # to be ended (in the worker) before the worker does anything else.
+            ended = _asyncio.wrap_future(
+                        worker.submit(_end_if_entered, entered, cm, exc))
+            if self.outer is None:
+                ended.add_done_callback(lambda f: adb._release_worker(worker))
+            await _asyncio.wait([ended])
+            raise
+        except BaseException:
+            if self.outer is None:
+                adb._release_worker(worker)
+            raise
+        self.worker = worker
+        self.cm = cm
+        self.token = adb._worker.set(worker)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        adb = self.adb
+        adb._worker.reset(self.token)
+        try:
+            # The worker runs one thing at a time, so even if this task is
+            # cancelled while waiting, the transaction is finished before the
+            # worker is used for anything else.
+            return await adb._call(self.worker, self.cm.__exit__, *exc_info)
+        finally:
+            if self.outer is None:
+                adb._release_worker(self.worker)
+
+
+
+#Licensed under the Apache License, Version 2.0 (the "License");
+#you may not use this file except in compliance with the License.
+#You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+#Unless required by applicable law or agreed to in writing, software
+#distributed under the License is distributed on an "AS IS" BASIS,
+#WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#See the License for the specific language governing permissions and
+#limitations under the License.
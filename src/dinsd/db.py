@@ -26,6 +26,16 @@ class Rollback(Exception):
     pass
 
 
+class ConflictError(Exception):
+
+    def __init__(self, relnames):
+        self.relnames = relnames
+
+    def __str__(self):
+        return ("transaction conflicts with concurrent changes to "
+                "{}").format(self.relnames)
+
+
 class DBConstraintLoop(ConstraintError):
 
     def __str__(self):
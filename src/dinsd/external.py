@@ -0,0 +1,482 @@
+#Copyright 2012, 2013 R. David Murray (see end comment for terms).
+"""Relational operators that spill to disk when their inputs are large.
+
+The operators in the dinsd module build their results, and any hash tables or
+sort buffers they need, in memory.  The versions here take their operands as
+iterables of rows (relations, the Streams returned by the operators in this
+module, or any other iterable with a header attribute) and produce a Stream: a
+one-shot iterable of the result rows, which also has a header.  None of them
+holds more than ``threshold`` rows in memory at once (except where noted);
+beyond that they write rows to temporary files, partitioned by hash or as
+sorted runs, and process the files a piece at a time.
+
+    threshold       The number of rows an operator may hold in memory.  Each
+                    operator also accepts a threshold keyword argument.
+    fanout          The number of partitions a spilled input is split into,
+                    and the number of sorted runs merged at once.
+    tempdir         The directory the temporary files are created in (None
+                    means the tempfile module's default).
+
+Like the rows of a relation, the rows of each operand are assumed to be
+distinct.
+
+"""
+
+import collections as _collections
+import heapq as _heapq
+import itertools as _itertools
+import operator as _operator
+import pickle as _pickle
+import tempfile as _tempfile
+from dinsd import (rel as _rel, expression_namespace as _expns, _get_type,
+                   _common_attrs)
+
+threshold = 100000
+fanout = 16
+tempdir = None
+
+# Partitioning more deeply than this only happens when many rows share the
+# same key, which further partitioning cannot separate.
+_MAX_DEPTH = 4
+# Rows are written to the temporary files in pickled batches of this size.
+_BATCH = 512
+
+
+class Stream:
+
+    def __init__(self, header, rows):
+        self.header = header
+        self._rows = iter(rows)
+
+    def __iter__(self):
+        return self._rows
+
+    def __repr__(self):
+        return "<{} {!r}>".format(self.__class__.__name__,
+                                  sorted(self.header))
+
+    def relation(self):
+        r = _rel(self.header)()
+        r._rows.update(self)
+        return r
+
+
+def _limit(value):
+    return threshold if value is None else value
+
+
+def _make(rowtype, attrs):
+    # The values have already been validated by the rows they came from.
+    row = rowtype.__new__(rowtype)
+    row.__dict__ = attrs
+    return row
+
+
+def _keyfunc(attrnames):
+    if not attrnames:
+        return lambda row: None
+    return _operator.attrgetter(*sorted(attrnames))
+
+
+class _Spill:
+
+    def __init__(self, rowtype):
+        self.rowtype = rowtype
+        self.file = _tempfile.TemporaryFile(dir=tempdir)
+        self.buffer = []
+        self.count = 0
+
+    def add(self, row):
+        self.buffer.append(vars(row))
+        self.count += 1
+        if len(self.buffer) >= _BATCH:
+            self._flush()
+
+    def _flush(self):
+        if self.buffer:
+            _pickle.dump(self.buffer, self.file, _pickle.HIGHEST_PROTOCOL)
+            self.buffer = []
+
+    def __iter__(self):
+        self._flush()
+        self.file.seek(0)
+        rowtype = self.rowtype
+        while True:
+            try:
+                batch = _pickle.load(self.file)
+            except EOFError:
+                return
+            for attrs in batch:
+                yield _make(rowtype, attrs)
+
+    def __len__(self):
+        return self.count
+
+    def close(self):
+        self.file.close()
+
+
+def _partition(rows, rowtype, key, level):
+    parts = [_Spill(rowtype) for i in range(fanout)]
+    for row in rows:
+        parts[hash((level, key(row))) % fanout].add(row)
+    return parts
+
+
+def _chunks(rows, limit):
+    rows = iter(rows)
+    while True:
+        chunk = list(_itertools.islice(rows, limit))
+        if not chunk:
+            return
+        yield chunk
+
+
+#
+# Join
+#
+
+
+def join(first, second, threshold=None):
+    """Natural join of first and second, hashing second.
+
+    If second has more than threshold rows both operands are partitioned
+    on their common attributes, and corresponding partitions joined.
+    """
+    header = first.header.copy()
+    header.update(second.header)
+    common = _common_attrs(first, second)
+    rows = _join(first, second, common, _get_type('row', header),
+                 _get_type('row', first.header),
+                 _get_type('row', second.header), _limit(threshold), 0)
+    return Stream(header, rows)
+
+
+def times(first, second, threshold=None):
+    if first.header.keys() & second.header.keys():
+        raise TypeError("Cannot multiply relations that share attributes")
+    return join(first, second, threshold=threshold)
+
+
+def _join(probe, build, common, rowtype, probetype, buildtype, limit, level):
+    key = _keyfunc(common)
+    index = _collections.defaultdict(list)
+    build = iter(build)
+    for count, row in enumerate(build, start=1):
+        index[key(row)].append(row)
+        if count > limit:
+            break
+    else:
+        for row in probe:
+            for row2 in index.get(key(row), ()):
+                attrs = vars(row).copy()
+                attrs.update(vars(row2))
+                yield _make(rowtype, attrs)
+        return
+    rest = _itertools.chain(_itertools.chain.from_iterable(index.values()),
+                            build)
+    if not common or level >= _MAX_DEPTH:
+        spill = _Spill(buildtype)
+        for row in rest:
+            spill.add(row)
+        index = None
+        try:
+            yield from _nested_loop(probe, spill, key, rowtype, limit)
+        finally:
+            spill.close()
+        return
+    buildparts = _partition(rest, buildtype, key, level)
+    index = None
+    probeparts = _partition(probe, probetype, key, level)
+    try:
+        for p, b in zip(probeparts, buildparts):
+            if len(b) > len(p):
+                # The join is symmetric; hash the smaller partition.
+                p, b = b, p
+                ptype, btype = buildtype, probetype
+            else:
+                ptype, btype = probetype, buildtype
+            yield from _join(p, b, common, rowtype, ptype, btype, limit,
+                             level+1)
+            p.close()
+            b.close()
+    finally:
+        for spill in probeparts + buildparts:
+            spill.close()
+
+
+def _nested_loop(probe, spill, key, rowtype, limit):
+    # Hash the probe a chunk at a time, scanning the spilled rows once for
+    # each chunk.
+    for chunk in _chunks(probe, limit):
+        index = _collections.defaultdict(list)
+        for row in chunk:
+            index[key(row)].append(row)
+        for row2 in spill:
+            for row in index.get(key(row2), ()):
+                attrs = vars(row).copy()
+                attrs.update(vars(row2))
+                yield _make(rowtype, attrs)
+
+
+#
+# Semijoins
+#
+
+
+def matching(first, second, threshold=None):
+    return _matcher(first, second, True, threshold)
+
+
+def notmatching(first, second, threshold=None):
+    return _matcher(first, second, False, threshold)
+
+
+def minus(first, second, threshold=None):
+    if not first.header == second.header:
+        raise TypeError("Relation types must match for minus operation")
+    return notmatching(first, second, threshold=threshold)
+
+
+def _matcher(first, second, match, threshold):
+    common = _common_attrs(first, second)
+    # Only the common attributes of second are needed.
+    keytype = _get_type('row', {n: second.header[n] for n in common})
+    keyrows = (_make(keytype, {n: getattr(row, n) for n in common})
+               for row in second)
+    rows = _match(first, keyrows, _keyfunc(common), match,
+                  _get_type('row', first.header), keytype,
+                  _limit(threshold), 0)
+    return Stream(first.header, rows)
+
+
+def _match(first, second, key, match, firsttype, keytype, limit, level):
+    keys = {}
+    second = iter(second)
+    for row in second:
+        keys.setdefault(key(row), row)
+        if len(keys) > limit and level < _MAX_DEPTH:
+            break
+    else:
+        for row in first:
+            if (key(row) in keys) == match:
+                yield row
+        return
+    keyparts = _partition(_itertools.chain(keys.values(), second), keytype,
+                          key, level)
+    keys = None
+    firstparts = _partition(first, firsttype, key, level)
+    try:
+        for f, k in zip(firstparts, keyparts):
+            yield from _match(f, k, key, match, firsttype, keytype, limit,
+                              level+1)
+    finally:
+        for spill in firstparts + keyparts:
+            spill.close()
+
+
+#
+# Duplicate elimination
+#
+
+
+def union(*sources, threshold=None):
+    if not sources:
+        raise TypeError("union requires at least one operand")
+    first, *rest = sources
+    for source in rest:
+        if not first.header == source.header:
+            raise TypeError("Union operands must of equal types")
+    rows = _distinct(_itertools.chain(*sources),
+                     _get_type('row', first.header), _limit(threshold), 0)
+    return Stream(first.header, rows)
+
+
+def project(source, attr_names, threshold=None):
+    if hasattr(attr_names, 'all_but'):
+        attr_names = attr_names.all_but(source)
+    header = {n: t for n, t in source.header.items() if n in attr_names}
+    if not len(header) == len(attr_names):
+        raise TypeError("Attribute list included unknown attributes: "
+                        "{}".format(attr_names - header.keys()))
+    rowtype = _get_type('row', header)
+    projected = (_make(rowtype, {n: v for n, v in vars(row).items()
+                                      if n in header})
+                 for row in source)
+    return Stream(header, _distinct(projected, rowtype, _limit(threshold), 0))
+
+
+def _distinct(rows, rowtype, limit, level):
+    # Rows are passed on the first time they are seen.  Once too many have
+    # been seen the remaining unseen ones are partitioned, and each partition
+    # is handled the same way.
+    seen = set()
+    rows = iter(rows)
+    for row in rows:
+        if row not in seen:
+            seen.add(row)
+            yield row
+            if len(seen) >= limit and level < _MAX_DEPTH:
+                break
+    else:
+        return
+    parts = _partition((row for row in rows if row not in seen),
+                       rowtype, lambda row: row, level)
+    seen = None
+    try:
+        for part in parts:
+            yield from _distinct(part, rowtype, limit, level+1)
+    finally:
+        for spill in parts:
+            spill.close()
+
+
+#
+# Aggregation
+#
+
+
+def summarize(source, attr_names, threshold=None, **new_attrs):
+    """Summarize BY attr_names, as dinsd.summarize does.
+
+    Each group's rows must fit in memory together, since they are the value
+    of _summary_.  Because the header of the result depends on the values
+    computed, the whole source is read (and partitioned if necessary) before
+    summarize returns.
+    """
+    header = {n: t for n, t in source.header.items() if n in attr_names}
+    if not len(header) == len(attr_names):
+        raise TypeError("Attribute list included unknown attributes: "
+                        "{}".format(attr_names - header.keys()))
+    for n, f in new_attrs.items():
+        if n in header:
+            raise ValueError("Duplicate relational attribute name "
+                             "{!r}".format(n))
+        if isinstance(f, str):
+            c = compile(f, '<summarize>', 'eval')
+            new_attrs[n] = lambda r, c=c: eval(c, _expns, r._as_locals())
+    summary = _rel({n: t for n, t in source.header.items()
+                         if n not in header})
+    summaryrow = _get_type('row', dict(header, _summary_=summary))
+    def summaries():
+        groups = _groups(source, _keyfunc(header),
+                         _get_type('row', source.header),
+                         _limit(threshold), 0)
+        for rows in groups:
+            r = summary()
+            r._rows.update(_make(summary.row,
+                                 {n: v for n, v in vars(row).items()
+                                       if n not in header})
+                           for row in rows)
+            attrs = {n: getattr(rows[0], n) for n in header}
+            attrs['_summary_'] = r
+            yield _make(summaryrow, attrs)
+    summaries = summaries()
+    first = next(summaries, None)
+    if first is None:
+        # Like extend, try a synthetic row to find the new types.
+        try:
+            rw = summaryrow({n: t() for n, t in summaryrow._header_.items()})
+            new_types = {n: type(f(rw)) for n, f in new_attrs.items()}
+        except Exception:
+            raise TypeError("Cannot summarize this empty input") from None
+    else:
+        new_types = {n: type(f(first)) for n, f in new_attrs.items()}
+        summaries = _itertools.chain([first], summaries)
+    result = dict(header, **new_types)
+    rowtype = _get_type('row', result)
+    def rows():
+        for s in summaries:
+            attrs = vars(s).copy()
+            del attrs['_summary_']
+            attrs.update((n, f(s)) for n, f in new_attrs.items())
+            yield rowtype(attrs)
+    return Stream(result, rows())
+
+
+def _groups(rows, key, rowtype, limit, level):
+    groups = _collections.defaultdict(list)
+    rows = iter(rows)
+    for count, row in enumerate(rows, start=1):
+        groups[key(row)].append(row)
+        if count > limit and level < _MAX_DEPTH:
+            break
+    else:
+        yield from groups.values()
+        return
+    parts = _partition(
+        _itertools.chain(_itertools.chain.from_iterable(groups.values()),
+                         rows),
+        rowtype, key, level)
+    groups = None
+    try:
+        for part in parts:
+            yield from _groups(part, key, rowtype, limit, level+1)
+    finally:
+        for spill in parts:
+            spill.close()
+
+
+#
+# Sorting
+#
+
+
+def sort(source, attr_names=None, reverse=False, threshold=None):
+    """Yield the rows of source ordered by attr_names (all, by default).
+
+    attr_names may be a single name or a list of names, most significant
+    first.  Sorted runs of threshold rows are written to temporary files and
+    merged, fanout runs at a time.
+    """
+    if attr_names is None:
+        attr_names = sorted(source.header)
+    elif isinstance(attr_names, str):
+        attr_names = [attr_names]
+    for n in attr_names:
+        if n not in source.header:
+            raise AttributeError("{!r} has no attribute {!r}".format(
+                                    source, n))
+    key = _operator.attrgetter(*attr_names)
+    rowtype = _get_type('row', source.header)
+    return Stream(source.header,
+                  _sort(source, key, reverse, rowtype, _limit(threshold)))
+
+
+def _sort(rows, key, reverse, rowtype, limit):
+    runs = []
+    try:
+        for chunk in _chunks(rows, limit):
+            chunk.sort(key=key, reverse=reverse)
+            if not runs and len(chunk) < limit:
+                yield from chunk
+                return
+            runs.append(_Spill(rowtype))
+            for row in chunk:
+                runs[-1].add(row)
+        while len(runs) > fanout:
+            merged = []
+            for group in _chunks(runs, fanout):
+                merged.append(_Spill(rowtype))
+                for row in _heapq.merge(*group, key=key, reverse=reverse):
+                    merged[-1].add(row)
+                for spill in group:
+                    spill.close()
+            runs = merged
+        yield from _heapq.merge(*runs, key=key, reverse=reverse)
+    finally:
+        for spill in runs:
+            spill.close()
+
+
+#Licensed under the Apache License, Version 2.0 (the "License");
+#you may not use this file except in compliance with the License.
+#You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+#Unless required by applicable law or agreed to in writing, software
+#distributed under the License is distributed on an "AS IS" BASIS,
+#WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#See the License for the specific language governing permissions and
+#limitations under the License.
@@ -0,0 +1,585 @@
+#Copyright 2012, 2013 R. David Murray (see end comment for terms).
+"""A dinsd persistent database implementation storing an append-only log.
+
+This back end provides the Database API of sqlite_pickle_db (less the parts
+listed at the end), and works the same way in memory, but instead of updating
+sqlite tables it appends each committed transaction's changes (the rows it
+inserted and deleted, and any changes to the relation definitions, keys,
+indexes, and row constraints) to a log file as a single checksummed record.
+A commit is therefore one sequential write (and fsync), however many rows it
+changes, and no matter what the rows' values are.
+
+Since the log only grows, from time to time the latest committed state of the
+database is written to a checkpoint file (the database file name plus
+'.checkpoint') and the log is restarted, keeping only the records committed
+while the checkpoint was being written.  This is done by a background thread,
+so committing transactions don't wait for it, once the log is bigger than
+both the checkpoint and compact_size bytes, or after every
+checkpoint_interval commits if that is set.  It is also done when the
+database is closed, and by calling the checkpoint method.
+
+Opening the database reads the checkpoint and then replays the log from start
+to finish.  A record at the end of the log that was only partially written
+(because the program died while writing it) is discarded.
+
+The ``Database`` constructor accepts these options:
+
+    sync            If True (the default), fsync the log after each commit,
+                    so that a transaction is durable once it has committed.
+    compact_size    The size in bytes the log must reach before it is
+                    compacted.
+    checkpoint_interval
+                    If not None, also write a checkpoint after every this
+                    many commits.
+
+The options of sqlite_pickle_db that are about how sqlite is used, as well
+as its change log, memory limit, and sharing between processes, are not
+supported, and neither are the methods that go with them: a log Database
+has no partition, partitioning, changes, or discard_changes method.
+
+"""
+
+import collections as _collections
+import operator as _operator
+import os as _os
+import pickle as _pickle
+import struct as _struct
+import tempfile as _tempfile
+import threading as _threading
+import warnings as _warnings
+import zlib as _zlib
+import dinsd.external as _external
+import dinsd.sqlite_pickle_db as _sqlite_pickle_db
+from dinsd import rel as _rel
+from dinsd.sqlite_pickle_db import _Published, _trusted_row
+
+
+class Database(_sqlite_pickle_db._Database):
+
+    def __init__(self, fn, debug_sql=False, sync=True, compact_size=1<<22,
+                 checkpoint_interval=None):
+        if fn == ':memory:':
+            raise ValueError("a log database must be stored in a file")
+        super().__init__(
+            _log_persistence(fn, sync=sync, compact_size=compact_size,
+                             checkpoint_interval=checkpoint_interval),
+            debug_sql=debug_sql)
+        state = self._storage.open()
+        versions = dict(state.versions)
+        self._claimed = dict(versions)
+        self._published = _Published({}, {}, versions)
+        for name, constraints in state.row_constraints.items():
+            self.row_constraints[name].update(constraints)
+        for name, header in state.headers.items():
+            self._add_loaded(name, state.relation(name),
+                             state.keys.get(name))
+        for name, indexes in state.indexes.items():
+            self._indexes[name] = {n: set(a) for n, a in indexes.items()}
+        # From here on the state only tracks the definitions, for the
+        # checkpoints; the rows are in the relations.
+        state.rows = None
+        self._published = _Published(dict(super().items()),
+                                     dict(self._system_relations), versions)
+        self._checkpoint_lock = _threading.Lock()
+        self._compactor = _threading.Thread(target=self._compact,
+                                            name='dinsd log compactor',
+                                            daemon=True)
+        self._compactor.start()
+
+    def _compact(self):
+        storage = self._storage
+        while True:
+            storage.compaction_due.wait()
+            storage.compaction_due.clear()
+            if storage.closing:
+                return
+            try:
+                self.checkpoint()
+            except Exception as e:
+                _warnings.warn("checkpointing {} failed: {!r}".format(
+                                    storage.dbfn, e), RuntimeWarning)
+
+    def checkpoint(self):
+        """Write a checkpoint of the latest committed state, and compact the
+        log.
+
+        This is done automatically, in a background thread, when the log
+        grows big enough, and when the database is closed.  Nothing is done
+        if nothing has been committed since the last checkpoint.
+        """
+        storage = self._storage
+        with self._checkpoint_lock:
+            # The relations have to be those of the committed state the log
+            # leads to, so wait until every commit written to the log has also
+            # been published.  Holding the writer keeps any more from being
+            # written meanwhile.
+            while True:
+                self._wait_for_commits()
+                with storage.write_lock:
+                    with self._commit_cond:
+                        published = self._published
+                    if published.versions == storage.state.versions:
+                        if not storage.frames:
+                            return
+                        start = storage.begin_checkpoint()
+                        break
+            path = storage.write_checkpoint(start, published.relations)
+            with storage.write_lock:
+                storage.finish_checkpoint(start, path)
+
+    def scan(self, relname, condition=None):
+        # Everything is in memory already.
+        r = self._published.relations[relname]
+        if condition is not None:
+            r = r.where(condition)
+        return _external.Stream(r.header, iter(r))
+
+    def close(self):
+        storage = self._storage
+        storage.closing = True
+        storage.compaction_due.set()
+        self._compactor.join()
+        self.checkpoint()
+        super().close()
+
+
+#
+# Log persistence infrastructure.
+#
+# The log file starts with _LOG_MAGIC and the log's generation number, and
+# then holds one frame per commit: the length and crc32 of the payload, and
+# the payload, which is a pickled list of operations.  The checkpoint file
+# starts with _CHECKPOINT_MAGIC, followed by a pickled dict holding the
+# definitions of the relations, the generation of the log that follows it,
+# and the offset in the previous generation's log of the first frame that the
+# checkpoint does not include; then, for each relation, a pickled tuple of its
+# name and a list of its rows as tuples of values in attribute name order.
+#
+# Compacting the log replaces the checkpoint, and then the log, each with a
+# new file of the next generation.  If we die between the two, the log is one
+# generation behind the checkpoint, and is replayed from the offset the
+# checkpoint records.
+#
+
+_LOG_MAGIC = b'dinsd log 1\n'
+_CHECKPOINT_MAGIC = b'dinsd checkpoint 1\n'
+_GENERATION = _struct.Struct('<Q')
+_FRAME = _struct.Struct('<II')
+_LOG_START = len(_LOG_MAGIC) + _GENERATION.size
+
+_fdatasync = getattr(_os, 'fdatasync', _os.fsync)
+
+
+def _values_getter(names):
+    # Return a function that returns the values of a row's attributes,
+    # ordered as in names, as a tuple.
+    getter = _operator.attrgetter(*names)
+    if len(names) == 1:
+        return lambda rw: (getter(rw),)
+    return getter
+
+
+def _replace(tmp, path):
+    _os.replace(tmp, path)
+    dirfd = _os.open(_os.path.dirname(_os.path.abspath(path)), _os.O_RDONLY)
+    try:
+        _os.fsync(dirfd)
+    finally:
+        _os.close(dirfd)
+
+
+class _LogState:
+
+    # The stored state of the database, built by replaying the checkpoint and
+    # the log, and kept up to date as frames are written.  rows is None except
+    # while the database is being opened.
+
+    def __init__(self):
+        self.headers = {}
+        self.rows = {}
+        self.versions = {}
+        self.keys = {}
+        self.indexes = _collections.defaultdict(dict)
+        self.row_constraints = _collections.defaultdict(dict)
+
+    def apply(self, ops):
+        for op, *args in ops:
+            getattr(self, '_' + op)(*args)
+
+    def relation(self, name):
+        header = self.headers[name]
+        r = _rel(**header)()
+        row, names = r.row, sorted(header)
+        r._rows.update(_trusted_row(row, dict(zip(names, values)))
+                       for values in self.rows[name])
+        return r
+
+    def definitions(self):
+        return dict(headers=dict(self.headers),
+                    versions=dict(self.versions),
+                    keys=dict(self.keys),
+                    indexes={n: dict(i) for n, i in self.indexes.items()},
+                    row_constraints={n: dict(c) for n, c
+                                     in self.row_constraints.items()})
+
+    def _reltype(self, name, header):
+        self.headers[name] = header
+        if self.rows is not None:
+            self.rows[name] = set()
+
+    def _insert(self, name, names, rows):
+        if self.rows is None:
+            return
+        order = sorted(names)
+        if list(names) != order:
+            pos = [names.index(n) for n in order]
+            rows = (tuple(values[i] for i in pos) for values in rows)
+        self.rows[name].update(rows)
+
+    def _delete(self, name, rows):
+        if self.rows is not None:
+            self.rows[name].difference_update(rows)
+
+    def _versions(self, versions):
+        self.versions.update(versions)
+
+    def _key(self, name, keynames):
+        self.keys[name] = keynames
+
+    def _index(self, name, indexname, attrnames):
+        self.indexes[name][indexname] = attrnames
+
+    def _dropindex(self, name, indexname):
+        del self.indexes[name][indexname]
+
+    def _constrain(self, name, constraints):
+        self.row_constraints[name].update(constraints)
+
+    def _unconstrain(self, name, names):
+        for n in names:
+            del self.row_constraints[name][n]
+
+
+class _log_persistence:
+
+    def __init__(self, fn, sync=True, compact_size=1<<22,
+                 checkpoint_interval=None):
+        self.dbfn = fn
+        self.checkpoint_path = fn + '.checkpoint'
+        self.sync = sync
+        self.compact_size = compact_size
+        self.checkpoint_interval = checkpoint_interval
+        self.shared = False
+        self.write_lock = _threading.RLock()
+        self.writer = _log_connection(self)
+        self.state = None
+        self.generation = 0
+        self.size = 0
+        self.frames = 0
+        self.checkpoint_size = 0
+        self.compaction_due = _threading.Event()
+        self.closing = False
+        self._log = None
+        self._trace = _threading.local()
+
+    def open(self):
+        state = self.state = _LogState()
+        generation, offset = 0, _LOG_START
+        try:
+            f = open(self.checkpoint_path, 'rb')
+        except FileNotFoundError:
+            pass
+        else:
+            with f:
+                if f.read(len(_CHECKPOINT_MAGIC)) != _CHECKPOINT_MAGIC:
+                    raise ValueError("{} is not a dinsd checkpoint".format(
+                                        self.checkpoint_path))
+                defs = _pickle.load(f)
+                generation, offset = defs.pop('generation'), defs.pop('offset')
+                for name, value in defs.items():
+                    getattr(state, name).update(value)
+                for name in state.headers:
+                    relname, rows = _pickle.load(f)
+                    state.rows[relname] = set(rows)
+                self.checkpoint_size = f.tell()
+            self.trace("read {} relations from {}".format(
+                        len(state.headers), self.checkpoint_path))
+        try:
+            with open(self.dbfn, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            data = None
+        if data is None:
+            self._new_log(generation, b'')
+            return state
+        if not data.startswith(_LOG_MAGIC) or len(data) < _LOG_START:
+            raise ValueError("{} is not a dinsd log".format(self.dbfn))
+        log_generation = _GENERATION.unpack_from(data, len(_LOG_MAGIC))[0]
+        if log_generation == generation:
+            start = _LOG_START
+        elif log_generation == generation - 1:
+            # We died while compacting: the frames before offset are in the
+            # checkpoint.
+            start = offset
+        else:
+            raise ValueError("log {} does not belong to checkpoint {}".format(
+                                self.dbfn, self.checkpoint_path))
+        end, frames = self._replay(data, start)
+        self.trace("replayed {} commits from {}".format(frames, self.dbfn))
+        if start != _LOG_START or end != len(data):
+            # Start a log with just the complete frames not already in the
+            # checkpoint.
+            self._new_log(generation, data[start:end])
+        else:
+            self._log = open(self.dbfn, 'ab')
+            self.generation = generation
+            self.size = len(data)
+        self.frames = frames
+        return state
+
+    def _replay(self, data, pos):
+        # Apply the frames in data from pos on, and return the position just
+        # past the last complete frame and the number of frames applied.
+        state = self.state
+        crc32, loads = _zlib.crc32, _pickle.loads
+        unpack_from = _FRAME.unpack_from
+        data = memoryview(data)
+        frames = 0
+        while pos + _FRAME.size <= len(data):
+            length, crc = unpack_from(data, pos)
+            start = pos + _FRAME.size
+            payload = data[start:start+length]
+            if len(payload) != length or crc32(payload) != crc:
+                break
+            state.apply(loads(payload))
+            pos = start + length
+            frames += 1
+        return pos, frames
+
+    def _new_log(self, generation, frames):
+        # Replace the log with one of the given generation, holding frames.
+        fd, tmp = _tempfile.mkstemp(dir=_os.path.dirname(
+                                        _os.path.abspath(self.dbfn)))
+        try:
+            with open(fd, 'wb') as f:
+                f.write(_LOG_MAGIC + _GENERATION.pack(generation) + frames)
+                f.flush()
+                _os.fsync(f.fileno())
+            _replace(tmp, self.dbfn)
+        except BaseException:
+            _os.unlink(tmp)
+            raise
+        if self._log is not None:
+            self._log.close()
+        self._log = open(self.dbfn, 'ab')
+        self.generation = generation
+        self.size = _LOG_START + len(frames)
+
+    # Transactions.  These are called with the write lock held, and
+    # end_transaction releases it.  The operations of a transaction are
+    # collected by the writer and written as a single frame when it commits.
+
+    def begin_transaction(self):
+        self.writer.savepoint('_dinsd_transaction')
+
+    def end_transaction(self, commit):
+        try:
+            if not commit:
+                self.writer.rollback_to('_dinsd_transaction')
+            self.writer.release('_dinsd_transaction')
+        finally:
+            self.write_lock.release()
+
+    def write(self, ops):
+        # Append a frame holding ops to the log.
+        if not ops:
+            return
+        payload = _pickle.dumps(ops, _pickle.HIGHEST_PROTOCOL)
+        try:
+            self._log.write(_FRAME.pack(len(payload), _zlib.crc32(payload)))
+            self._log.write(payload)
+            self._log.flush()
+            if self.sync:
+                _fdatasync(self._log.fileno())
+        except BaseException:
+            # Don't leave a partial frame for the next one to follow.
+            self._log.seek(self.size)
+            self._log.truncate()
+            raise
+        self.state.apply(ops)
+        self.size += _FRAME.size + len(payload)
+        self.frames += 1
+        if (self.size - _LOG_START >= self.compact_size and
+                self.size >= self.checkpoint_size or
+                self.checkpoint_interval is not None and
+                self.frames >= self.checkpoint_interval):
+            self.compaction_due.set()
+
+    # Checkpoints.  begin_checkpoint and finish_checkpoint are called with
+    # the write lock held, and write_checkpoint without it.
+
+    def begin_checkpoint(self):
+        # Return where the log stands now that the committed state is the
+        # state to write.
+        return self.generation, self.size, self.state.definitions()
+
+    def write_checkpoint(self, start, relations):
+        generation, offset, defs = start
+        defs.update(generation=generation+1, offset=offset)
+        fd, tmp = _tempfile.mkstemp(dir=_os.path.dirname(
+                                        _os.path.abspath(self.dbfn)))
+        try:
+            with open(fd, 'wb') as f:
+                f.write(_CHECKPOINT_MAGIC)
+                _pickle.dump(defs, f, _pickle.HIGHEST_PROTOCOL)
+                for name, header in defs['headers'].items():
+                    values = _values_getter(sorted(header))
+                    rows = [values(rw) for rw in relations[name]]
+                    _pickle.dump((name, rows), f, _pickle.HIGHEST_PROTOCOL)
+                f.flush()
+                _os.fsync(f.fileno())
+        except BaseException:
+            _os.unlink(tmp)
+            raise
+        self.trace("wrote {} relations to {}".format(len(defs['headers']),
+                                                      self.checkpoint_path))
+        return tmp
+
+    def finish_checkpoint(self, start, path):
+        # Install the checkpoint written to path, and restart the log with the
+        # frames written since start.
+        generation, offset, defs = start
+        with open(self.dbfn, 'rb') as f:
+            f.seek(offset)
+            frames = f.read()
+        self.checkpoint_size = _os.path.getsize(path)
+        _replace(path, self.checkpoint_path)
+        self._new_log(generation + 1, frames)
+        self.frames = 0
+
+    def close(self):
+        with self.write_lock:
+            if self._log is not None:
+                self._log.close()
+                self._log = None
+
+    # Tracing is per-thread, like sqlite_pickle_db's SQL tracing; what is
+    # traced is what is written to and read from the files.
+
+    def set_trace(self, debug_sql):
+        self._trace.debug_sql = debug_sql
+
+    def trace(self, msg):
+        debug_sql = getattr(self._trace, 'debug_sql', False)
+        if debug_sql:
+            print(msg, file=None if debug_sql is True else debug_sql)
+
+
+class _log_connection:
+
+    # The writer collects the operations of the current transaction.  Like an
+    # sqlite connection in autocommit mode, once no savepoint is active any
+    # operations collected are committed: written to the log.
+
+    def __init__(self, storage):
+        self.storage = storage
+        self.ops = []
+        self._savepoints = []
+
+    def __enter__(self):
+        self.savepoint('_dinsd')
+        return self
+
+    def __exit__(self, exc_type, exc_info, tb):
+        if exc_type is not None:
+            self.rollback_to('_dinsd')
+        self.release('_dinsd')
+
+    def _find(self, name):
+        for i in range(len(self._savepoints) - 1, -1, -1):
+            if self._savepoints[i][0] == name:
+                return i
+        raise ValueError("no such savepoint: {}".format(name))
+
+    def savepoint(self, name):
+        self._savepoints.append((name, len(self.ops)))
+
+    def rollback_to(self, name):
+        del self.ops[self._savepoints[self._find(name)][1]:]
+
+    def release(self, name):
+        del self._savepoints[self._find(name):]
+        if not self._savepoints:
+            ops, self.ops = self.ops, []
+            self.storage.write(ops)
+
+    def _add(self, op, description):
+        self.ops.append(op)
+        self.storage.trace(description)
+
+    def _header(self, name):
+        for op in reversed(self.ops):
+            if op[0] == 'reltype' and op[1] == name:
+                return op[2]
+        return self.storage.state.headers[name]
+
+    def add_reltype(self, name, header):
+        self._add(('reltype', name, dict(header)),
+                  "define {} {}".format(name, sorted(header)))
+
+    def insert_rows(self, name, names, rows):
+        values = _values_getter(names)
+        rows = [values(rw) for rw in rows]
+        if rows:
+            self._add(('insert', name, list(names), rows),
+                      "insert {} rows into {}".format(len(rows), name))
+
+    def delete_rows(self, name, key, rows):
+        # Whole rows are logged, whatever the key, since that is what replay
+        # removes.
+        rows = list(rows)
+        if rows:
+            values = _values_getter(sorted(self._header(name)))
+            self._add(('delete', name, [values(rw) for rw in rows]),
+                      "delete {} rows from {}".format(len(rows), name))
+
+    def set_versions(self, versions):
+        self._add(('versions', dict(versions)),
+                  "set versions {}".format(sorted(versions.items())))
+
+    def set_key(self, relname, keynames):
+        self._add(('key', relname, list(keynames)),
+                  "set key of {} to {}".format(relname, list(keynames)))
+
+    def create_index(self, relname, indexname, attrnames):
+        self._add(('index', relname, indexname, list(attrnames)),
+                  "create index {} on {} {}".format(indexname, relname,
+                                                    list(attrnames)))
+
+    def drop_index(self, relname, indexname):
+        self._add(('dropindex', relname, indexname),
+                  "drop index {} on {}".format(indexname, relname))
+
+    def add_row_constraints(self, relname, constraints):
+        self._add(('constrain', relname, dict(constraints)),
+                  "add row constraints {} to {}".format(sorted(constraints),
+                                                         relname))
+
+    def del_row_constraints(self, relname, names):
+        self._add(('unconstrain', relname, tuple(names)),
+                  "remove row constraints {} from {}".format(list(names),
+                                                              relname))
+
+
+
+#Licensed under the Apache License, Version 2.0 (the "License");
+#you may not use this file except in compliance with the License.
+#You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+#Unless required by applicable law or agreed to in writing, software
+#distributed under the License is distributed on an "AS IS" BASIS,
+#WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#See the License for the specific language governing permissions and
+#limitations under the License.
@@ -0,0 +1,242 @@
+#Copyright 2012, 2013 R. David Murray (see end comment for terms).
+"""Rules for splitting the rows of a relation into partitions.
+
+A Partitioning assigns each row of a relation to one of a fixed number of
+partitions, numbered from zero, by the values of some of its attributes (the
+partitioning attributes):
+
+    hash            With shards=n, a row goes in the partition given by a hash
+                    of its partitioning values, modulo n.  The hash is
+                    computed from the pickled values, so that it is the same
+                    in every process; the values should therefore be of simple
+                    types (str, int, and the like) whose pickles depend only on
+                    their value.
+    range           With ranges=[b1, b2, ...], a sorted list of boundaries, a
+                    row goes in partition 0 if its value is less than b1, in
+                    partition 1 if it is at least b1 but less than b2, and so
+                    on.  With more than one partitioning attribute, the value
+                    is the tuple of the values in attribute name order, and so
+                    are the boundaries.
+
+Given a condition string of the kind passed to where, prune works out which
+partitions can hold rows that satisfy it, from comparisons of the
+partitioning attributes with values that don't depend on the row.  It
+understands ==, in (with a literal tuple, list, or set), and for range
+partitioning on a single attribute <, <=, >, and >=, combined with and and or.
+Anything else in the condition just doesn't narrow down the partitions.
+
+"""
+
+import ast as _ast
+import bisect as _bisect
+import collections as _collections
+import itertools as _itertools
+import operator as _operator
+import pickle as _pickle
+import zlib as _zlib
+import dinsd as _dinsd
+from dinsd import expression_namespace as _expns
+
+# The pickle protocol used to hash values.  Changing it would move rows to
+# different partitions.
+_HASH_PROTOCOL = 3
+
+# The most combinations of values == and in comparisons may produce before
+# prune gives up on them.
+_MAX_COMBINATIONS = 1000
+
+
+class Partitioning:
+
+    def __init__(self, header, attrnames, shards=None, ranges=None):
+        if not attrnames:
+            raise ValueError("at least one partitioning attribute is required")
+        for n in attrnames:
+            if n not in header:
+                raise AttributeError("no attribute {!r} in {}".format(
+                                        n, sorted(header)))
+        if (shards is None) == (ranges is None):
+            raise TypeError("exactly one of shards and ranges must be given")
+        self.header = dict(header)
+        self.attrnames = sorted(attrnames)
+        self.types = [header[n] for n in self.attrnames]
+        self.shards = shards
+        self.ranges = None if ranges is None else list(ranges)
+        if shards is not None and shards < 1:
+            raise ValueError("shards must be at least 1, not {}".format(
+                                shards))
+        if ranges is not None:
+            if any(a >= b for a, b in zip(self.ranges, self.ranges[1:])):
+                raise ValueError("ranges must be in increasing order")
+        self._values = _operator.attrgetter(*self.attrnames)
+
+    def __len__(self):
+        if self.shards is not None:
+            return self.shards
+        return len(self.ranges) + 1
+
+    def __repr__(self):
+        if self.shards is not None:
+            return "Partitioning({}, shards={})".format(self.attrnames,
+                                                        self.shards)
+        return "Partitioning({}, ranges={!r})".format(self.attrnames,
+                                                      self.ranges)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_values']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._values = _operator.attrgetter(*self.attrnames)
+
+    def names(self, relname):
+        """Return the names of the relations holding relname's partitions."""
+        return ['{}__{}'.format(relname, i) for i in range(len(self))]
+
+    def partition_of(self, rw):
+        """Return the number of the partition row rw belongs in."""
+        return self._index(self._values(rw))
+
+    def _index(self, value):
+        # value is the single partitioning value, or the tuple of them.
+        if self.shards is None:
+            return _bisect.bisect_right(self.ranges, value)
+        if len(self.attrnames) == 1:
+            value = (value,)
+        h = 0
+        for v in value:
+            h = _zlib.crc32(_pickle.dumps(v, _HASH_PROTOCOL), h)
+        return h % self.shards
+
+    def prune(self, condition):
+        """Return the sorted numbers of the partitions that can hold rows
+        satisfying the expression string condition.
+        """
+        try:
+            tree = _ast.parse(condition, mode='eval')
+        except SyntaxError:
+            return list(range(len(self)))
+        found = self._prune(tree.body)
+        if found is None:
+            return list(range(len(self)))
+        return sorted(found)
+
+    # Each of these returns the set of partitions that can hold rows for
+    # which node is true, or None if it could be any of them.
+
+    def _prune(self, node):
+        if isinstance(node, _ast.BoolOp):
+            found = [self._prune(v) for v in node.values]
+            if isinstance(node.op, _ast.Or):
+                if None in found:
+                    return None
+                return set().union(*found)
+            return self._conjunction(node.values, found)
+        if isinstance(node, _ast.Compare):
+            return self._conjunction([node], [None])
+        return None
+
+    def _conjunction(self, nodes, found):
+        # Combine what the comparisons among nodes say about the partitioning
+        # values with what is already known (found) about each node.
+        candidates = {}
+        low = high = None
+        for node in nodes:
+            if not isinstance(node, _ast.Compare):
+                continue
+            operands = [node.left] + node.comparators
+            for left, op, right in zip(operands, node.ops, operands[1:]):
+                if not isinstance(left, _ast.Name) and type(op) in _mirrored:
+                    left, right, op = right, left, _mirrored[type(op)]
+                if (not isinstance(left, _ast.Name) or
+                        left.id not in self.attrnames):
+                    continue
+                i = self.attrnames.index(left.id)
+                if isinstance(op, _ast.Eq):
+                    values = [self._constant(right, i)]
+                elif (isinstance(op, _ast.In) and
+                        isinstance(right, (_ast.Tuple, _ast.List, _ast.Set))):
+                    values = [self._constant(e, i) for e in right.elts]
+                elif (isinstance(op, _ranged) and self.ranges is not None and
+                        len(self.attrnames) == 1):
+                    value = self._constant(right, i)
+                    if value is _unknown:
+                        continue
+                    if isinstance(op, (_ast.Lt, _ast.LtE)):
+                        high = value if high is None else min(high, value)
+                    else:
+                        low = value if low is None else max(low, value)
+                    continue
+                else:
+                    continue
+                if any(v is _unknown for v in values):
+                    continue
+                values = set(values)
+                if left.id in candidates:
+                    candidates[left.id] &= values
+                else:
+                    candidates[left.id] = values
+        if len(candidates) == len(self.attrnames):
+            pools = [candidates[n] for n in self.attrnames]
+            count = 1
+            for p in pools:
+                count *= len(p)
+            if count <= _MAX_COMBINATIONS:
+                if len(pools) == 1:
+                    combinations = pools[0]
+                else:
+                    combinations = _itertools.product(*pools)
+                found = found + [{self._index(v) for v in combinations}]
+        if low is not None or high is not None:
+            first = 0 if low is None else self._index(low)
+            last = len(self) - 1 if high is None else self._index(high)
+            found = found + [set(range(first, last + 1))]
+        known = [f for f in found if f is not None]
+        if not known:
+            return None
+        return set.intersection(*known)
+
+    def _constant(self, node, i):
+        # Return the value of node if it doesn't depend on the row and is of
+        # the type of the i'th partitioning attribute (a value of some other
+        # type might compare equal to values that hash differently).  Any
+        # attribute name refers to the row, even if the namespace has a value
+        # of the same name.
+        for n in _ast.walk(node):
+            if isinstance(n, _ast.Name) and (n.id in self.header or
+                                             n.id == '_row_'):
+                return _unknown
+        try:
+            code = compile(_ast.Expression(node), '<partition>', 'eval')
+            value = eval(code, _expns, _collections.ChainMap(
+                                                _dinsd.ns.current))
+        except Exception:
+            return _unknown
+        if type(value) is not self.types[i]:
+            return _unknown
+        return value
+
+
+_unknown = object()
+
+# The operator that means the same thing with its operands swapped.
+_mirrored = {_ast.Eq: _ast.Eq(), _ast.Lt: _ast.Gt(), _ast.LtE: _ast.GtE(),
+             _ast.Gt: _ast.Lt(), _ast.GtE: _ast.LtE()}
+
+_ranged = (_ast.Lt, _ast.LtE, _ast.Gt, _ast.GtE)
+
+
+
+#Licensed under the Apache License, Version 2.0 (the "License");
+#you may not use this file except in compliance with the License.
+#You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+#Unless required by applicable law or agreed to in writing, software
+#distributed under the License is distributed on an "AS IS" BASIS,
+#WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#See the License for the specific language governing permissions and
+#limitations under the License.
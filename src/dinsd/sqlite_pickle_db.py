@@ -4,25 +4,110 @@
 This is the simplest possible implementation of a dinsd back end, and therefore
 has various issues.  For one, it holds the entire database in memory during
 normal processing.  For another, it does not query the sqlite back end when
-data is accessed.  This means that there can only ever be one application
-program reading and writing the database (though that application can run
-multiple threads).  This is not, however, enforced in any way currently, so you
-can shoot yourself in the foot by trying it.
+data is accessed.  This means that by default there can only ever be one
+application program reading and writing the database (though that application
+can run multiple threads).  This is not enforced in any way, so you can shoot
+yourself in the foot by trying it.  Opening the database with shared=True
+makes it safe for several processes to use it at once: each then checks for
+changes made by the others when a transaction starts.
+
+Each thread's transactions work on a snapshot of the database taken when the
+outermost transaction starts.  A transaction that read or changed a relation
+that another thread has changed since then raises ConflictError when it
+commits; Database.run_transaction retries such transactions.
+
+Database.partition creates a relation whose rows are divided among several
+relations (its partitions) by a dinsd.partitioning.Partitioning, each stored
+in an sqlite file of its own, so that transactions that change different
+partitions neither conflict nor wait for each other's writer.
+
+All writes go through a single sqlite connection shared by the application's
+threads, while the initial load (and any other reading from sqlite) is done
+through a bounded pool of read-only connections.  The ``Database`` constructor
+accepts some options that control how sqlite is used:
+
+    wal             If True, put the database in write-ahead-log mode, so
+                    that reading from the database does not block behind a
+                    writer, and vice versa.
+    synchronous     The sqlite ``synchronous`` level (``'off'``,
+                    ``'normal'``, ``'full'``, or ``'extra'``) to use for the
+                    writer connection.  ``'normal'`` is usually what you want
+                    with ``wal``.  The default is sqlite's default.
+    readers         The maximum number of read-only connections to keep open.
+    group_commit    If not None, the number of seconds to hold the sqlite
+                    transaction open after a dinsd transaction commits, so
+                    that the transactions committed by other threads in the
+                    meantime can share a single sqlite commit (and fsync).
+                    Each committing thread still waits until its changes are
+                    durable, and gets any error from the shared commit.
+    group_commit_size
+                    Commit the group as soon as it contains this many
+                    transactions, even if the time has not yet elapsed.
+    changelog       If True, record the rows inserted into and deleted from
+                    each relation by every commit, so that they can be read
+                    back, by this or any other process, using the changes
+                    method.
+    memory_limit    If not None, the approximate number of rows to keep in
+                    memory.  When there are more than that, the relations
+                    that were used least recently are dropped from memory,
+                    and read back from sqlite the next time they are used.
+    lazy            If True, don't load the relations when the database is
+                    opened, but read each one from sqlite the first time its
+                    rows are used.
+    preload_processes
+                    If not None, the number of processes to use to read and
+                    decode the relations when the database is opened.  Each
+                    process reads a range of rows over its own sqlite
+                    connection.  All the relations are then in memory at
+                    once, whatever the memory limit.
+    shared          If True, other processes may be using the database too.
+                    At the start of each outermost transaction the Database
+                    checks whether another process has committed changes
+                    (which is cheap when none has), and if so reloads the
+                    relations that were changed.  Commits are checked for
+                    conflicts with other processes as well as other threads.
+    snapshot        If True, keep a snapshot of the relations in a second
+                    file (the database file name plus '.snapshot') from
+                    which they can be loaded much faster than from sqlite.
+                    The snapshot is written by write_snapshot and when the
+                    database is closed.  When the database is opened, the
+                    relations that have not changed since the snapshot was
+                    written are loaded from it, and the rest from sqlite.
+    snapshot_interval
+                    If not None, also write the snapshot after every this
+                    many commits.
+    metrics         If True, count and time the work done in sqlite, in a
+                    Metrics object that is the Database's metrics attribute
+                    (which is otherwise None).
 
 """
 
+import bisect as _bisect
 import collections as _collections
+import collections.abc as _collections_abc
+import concurrent.futures as _futures
 import contextlib as _contextlib
 import functools as _functools
+import heapq as _heapq
+import itertools as _itertools
+import mmap as _mmap
+import operator as _operator
+import os as _os
 import pickle as _pickle
 import sqlite3 as _sqlite
+import tempfile as _tempfile
 import threading as _threading
+import time as _time
+import urllib.parse as _urllib_parse
+import warnings as _warnings
 import weakref as _weakref
 import dinsd as _dinsd
+import dinsd.external as _external
+import dinsd.partitioning as _partitioning
 from dinsd import (rel as _rel, expression_namespace as _expns, _Relation,
                    _hsig, display as _display)
 from dinsd.db import (ConstraintError, RowConstraintError, DBConstraintLoop,
-                      Rollback, _R)
+                      Rollback, ConflictError, _R)
 
 # For debugging only.
 import sys as _sys
@@ -41,15 +126,12 @@ class PersistentRelation(_Relation):
         self.key = None
         super().__init__(*args)
 
-    # Local Decorator.
+    # Local Decorator (see Database._transaction_required).
     def _transaction_required(meth):
         @_functools.wraps(meth)
         def transaction_required_wrapper(self, *args, **kw):
-            if self.db.transactions:
+            with self.db.transaction():
                 meth(self, *args, **kw)
-            else:
-                with self.db.transaction():
-                    meth(self, *args, **kw)
         return transaction_required_wrapper
 
     def __str__(self):
@@ -66,11 +148,18 @@ class PersistentRelation(_Relation):
         new.key = self.key
         return new
 
+    def _current(self):
+        # The value of this relation in the current transaction, which is not
+        # necessarily self: self may have been fetched before the transaction
+        # started, or before an earlier update replaced it.
+        return self.db[self.name]
+
     @_transaction_required
     def insert(self, rows):
         if hasattr(rows, '_header_'):
             rows = ~rows
-        new = self.copy()
+        new = self._current().copy()
+        added = _rel(self.header)()
         for rw in rows:
             if rw in new._rows:
                 raise ConstraintError("row {} already in relation".format(rw))
@@ -78,9 +167,16 @@ class PersistentRelation(_Relation):
                 raise TypeError("Type of inserted row ({}) does not match "
                                 "type of relation ({})".format(rw._header_,
                                                                self.header))
-            self.db._check_row_constraint(self.name, new, rw)
-            self.db._insert_row(self.name, rw)
             new._rows.add(rw)
+            added._rows.add(rw)
+        if not added:
+            return
+        # Validate, maintain the key, and write the new rows as a batch rather
+        # than row by row.
+        self.db._check_row_constraints(self.name, added)
+        self.db._extend_key(self.name, added)
+        self.db._insert_rows(self.name, added)
+        self.db._log_rows(self.name, inserted=added._rows)
         self.db._transaction_ns.current[self.name] = new
         self.db._check_db_constraints()
 
@@ -95,31 +191,39 @@ class PersistentRelation(_Relation):
                 raise ValueError("Unknown attribute name {!r}".format(n))
             if isinstance(f, str):
                 c = compile(f, '<update-'+n+'>', 'eval')
-                changes[n] = lambda r, c=c: eval(c, _expns, r._as_locals())
-        self.db._transaction_ns.current[self.name] = new = self.copy()
-        key = self.header.keys() if self.key is None else self.key
-        for rw in self:
-            if not condition(rw):
-                continue
-            new._rows.remove(rw)
-            # XXX This key update can be made WAY more efficient, this
-            # way of doing it is a complete hack.
-            if '_sys_key_'+self.name in self.db._system_ns.current:
-                self.db._update_key(self.name)
+                f = lambda r, c=c: eval(c, _expns, r._as_locals())
+            changes[n] = f
+        current = self._current()
+        old_rows = _rel(self.header)()
+        old_rows._rows = {rw for rw in current if condition(rw)}
+        if not old_rows:
+            return
+        new_rows = _rel(self.header)()
+        for rw in old_rows:
             new_rw = rw.copy()
-            updates = {}
             for attrname, change in changes.items():
-                val = change(rw)
-                setattr(new_rw, attrname, val)
-                updates[attrname] = val
-            self.db._check_row_constraint(self.name, new, new_rw)
-            # XXX this is very inefficient, but we can't do better unless we
-            # learn to parse expression strings and turn them into SQL...
-            self.db._update_row(self.name, rw >> key, updates)
-            new._rows.add(new_rw)
-            if '_sys_key_'+self.name in self.db._system_ns.current:
-                self.db._update_key(self.name)
+                setattr(new_rw, attrname, change(rw))
+            new_rows._rows.add(new_rw)
+        # Validate the updated rows as a batch against the relation and key
+        # with the old rows already removed.
+        new = current.copy()
+        new._rows -= old_rows._rows
         self.db._transaction_ns.current[self.name] = new
+        self.db._remove_key(self.name, old_rows)
+        self.db._check_row_constraints(self.name, new_rows)
+        self.db._extend_key(self.name, new_rows)
+        # XXX If we could turn expression strings into SQL we could do this
+        # with a single update statement, but the stored values are pickles,
+        # so instead we delete the old versions of the rows and insert the new.
+        key = self.header.keys() if current.key is None else current.key
+        deleted = old_rows._rows - new_rows._rows
+        added = _rel(self.header)()
+        added._rows = new_rows._rows - current._rows
+        with self.db._con.to(self.name):
+            self.db._delete_rows(self.name, key, deleted)
+            self.db._insert_rows(self.name, added)
+        self.db._log_rows(self.name, added._rows, deleted)
+        new._rows |= new_rows._rows
         self.db._check_db_constraints()
 
     @_transaction_required
@@ -127,17 +231,62 @@ class PersistentRelation(_Relation):
         if isinstance(condition, str):
             c = compile(condition, '<delete>', 'eval')
             condition = lambda r, c=c: eval(c, _expns, r._as_locals())
-        key = self.header.keys() if self.key is None else self.key
-        new = self.copy()
-        for rw in self:
-            if not condition(rw):
-                continue
-            new._rows.remove(rw)
-            self.db._delete_row(self.name, rw >> key, rw)
+        current = self._current()
+        old_rows = _rel(self.header)()
+        old_rows._rows = {rw for rw in current if condition(rw)}
+        if not old_rows:
+            return
+        new = current.copy()
+        new._rows -= old_rows._rows
+        self.db._remove_key(self.name, old_rows)
+        key = self.header.keys() if current.key is None else current.key
+        self.db._delete_rows(self.name, key, old_rows)
+        self.db._log_rows(self.name, deleted=old_rows._rows)
         self.db._transaction_ns.current[self.name] = new
         self.db._check_db_constraints()
 
-            
+
+class _EvictableRelation(PersistentRelation):
+
+    # A PersistentRelation of a Database that has a memory limit or is loaded
+    # lazily.  Once it has been committed, the Database's _RelationCache may
+    # drop its rows (or, when loading lazily, may not have read them yet),
+    # which are then read from sqlite when they are next needed.
+
+    _cached = False
+
+    @property
+    def _rows(self):
+        rows = self.__dict__['_rows']
+        if rows is None:
+            return self.db._cache.load(self)
+        if self._cached:
+            self.db._cache.touch(self)
+        return rows
+
+    @_rows.setter
+    def _rows(self, rows):
+        self.__dict__['_rows'] = rows
+
+    def __len__(self):
+        rows = self.__dict__['_rows']
+        if rows is None:
+            return self._evicted_len
+        return len(rows)
+
+    def order_by(self, attrnames, descending=False, limit=None, offset=0):
+        # If the rows are not in memory, pick out the ones wanted as they are
+        # read from sqlite, rather than loading them all to do it.
+        if (self.__dict__['_rows'] is None and limit is not None and
+                _versioned_name(self.name) == self.name):
+            names, stop = _dinsd._order_args(self, attrnames, limit, offset)
+            if offset < stop:
+                return _dinsd._top(self.db._cache.scan(self),
+                                   _dinsd._order_key(names),
+                                   descending, stop)[offset:]
+        return super().order_by(attrnames, descending, limit, offset)
+
+
 class DisconnectedPersistentRelation:
     pass
 
@@ -147,30 +296,642 @@ class DisconnectedPersistentRelation:
 
 _persistent_type_registry = _weakref.WeakValueDictionary()
 
-def _get_persistent_type(r):
-    hsig = _hsig(r.header)
+def _get_persistent_type(r, evictable=False):
+    base = _EvictableRelation if evictable else PersistentRelation
+    hsig = (_hsig(r.header), evictable)
     cls = _persistent_type_registry.get(hsig)
     if cls is None:
         rcls = r.__class__
         dct = dict(rcls.__dict__)
         name = PersistentRelation.__name__ + '(' + rcls.__name__.split('(', 1)[1]
-        cls = type(name, (PersistentRelation,), dct)
+        cls = type(name, (base,), dct)
         _persistent_type_registry[hsig] = cls
     return cls
 
 
+class PartitionedRelation(_Relation):
+
+    # The value of a relation created by Database.partition: the union of the
+    # relations holding its partitions, which are only looked up when they are
+    # used, so that a transaction doesn't read partitions it doesn't need.
+    # Outside a transaction, those are the ones committed when the value was
+    # fetched from the database.
+
+    def __init__(self, db, name):
+        self.db = db
+        self.name = name
+        self.partitioning = db._partitioned[name]
+        self._names = self.partitioning.names(name)
+        if db.transactions:
+            self._lookup = db.__getitem__
+        else:
+            self._lookup = db._published.relations.__getitem__
+
+    # Local Decorator (see Database._transaction_required).
+    def _transaction_required(meth):
+        @_functools.wraps(meth)
+        def transaction_required_wrapper(self, *args, **kw):
+            with self.db.transaction():
+                meth(self, *args, **kw)
+        return transaction_required_wrapper
+
+    @property
+    def _rows(self):
+        return set().union(*(p._rows for p in self.partitions()))
+
+    @property
+    def key(self):
+        return self._lookup(self._names[0]).key
+
+    def partitions(self, condition=None):
+        """Return the partitions that can hold rows satisfying condition.
+
+        condition is an expression string, as for where; without one all the
+        partitions are returned.
+        """
+        if condition is None:
+            indexes = range(len(self._names))
+        else:
+            indexes = self.partitioning.prune(condition)
+        return [self._lookup(self._names[i]) for i in indexes]
+
+    def __iter__(self):
+        return _itertools.chain.from_iterable(self.partitions())
+
+    def __len__(self):
+        return sum(len(p) for p in self.partitions())
+
+    def __contains__(self, row):
+        if getattr(row, '_header_', None) != self.header:
+            return False
+        i = self.partitioning.partition_of(row)
+        return row in self._lookup(self._names[i])
+
+    def where(self, condition):
+        if not isinstance(condition, str):
+            return super().where(condition)
+        new = _rel(self.header)()
+        for p in self.partitions(condition):
+            new._rows.update(p.where(condition)._rows)
+        return new
+
+    def order_by(self, attrnames, descending=False, limit=None, offset=0):
+        # Merge the first rows of each partition.
+        names, stop = _dinsd._order_args(self, attrnames, limit, offset)
+        firsts = [p.order_by(names, descending, stop)
+                  for p in self.partitions()]
+        merged = _heapq.merge(*firsts, key=_dinsd._order_key(names),
+                              reverse=descending)
+        return list(_itertools.islice(merged, offset, stop))
+
+    def __str__(self):
+        return self.display(*sorted(self.header))
+
+    def display(self, *args, **kw):
+        if 'highlight' not in kw:
+            kw['highlight'] = self.key or []
+        return _display(self, *args, **kw)
+
+    @_transaction_required
+    def insert(self, rows):
+        if hasattr(rows, '_header_'):
+            rows = ~rows
+        parts = self.db._split(self.partitioning, rows)
+        for name, part in zip(self._names, parts):
+            if part:
+                self.db[name].insert(part)
+
+    @_transaction_required
+    def update(self, condition, **kw):
+        # An update can move rows from one partition to another, so it is
+        # done as a delete from the partitions holding the old rows followed
+        # by an insert into those that the new rows belong in.
+        if isinstance(condition, str):
+            names = [self._names[i]
+                     for i in self.partitioning.prune(condition)]
+            c = compile(condition, '<update>', 'eval')
+            condition = lambda r, c=c: eval(c, _expns, r._as_locals())
+        else:
+            names = self._names
+        changes = {}
+        for n, f in kw.items():
+            if n not in self.header:
+                raise ValueError("Unknown attribute name {!r}".format(n))
+            if isinstance(f, str):
+                c = compile(f, '<update-'+n+'>', 'eval')
+                f = lambda r, c=c: eval(c, _expns, r._as_locals())
+            changes[n] = f
+        new_rows = []
+        for name in names:
+            old_rows = {rw for rw in self.db[name] if condition(rw)}
+            if not old_rows:
+                continue
+            for rw in old_rows:
+                new_rw = rw.copy()
+                for attrname, change in changes.items():
+                    setattr(new_rw, attrname, change(rw))
+                new_rows.append(new_rw)
+            self.db[name].delete(old_rows.__contains__)
+        parts = self.db._split(self.partitioning, new_rows)
+        for name, part in zip(self._names, parts):
+            part._rows -= self.db[name]._rows
+            if part:
+                self.db[name].insert(part)
+
+    @_transaction_required
+    def delete(self, condition):
+        if isinstance(condition, str):
+            names = [self._names[i]
+                     for i in self.partitioning.prune(condition)]
+        else:
+            names = self._names
+        for name in names:
+            self.db[name].delete(condition)
+
+
+_partitioned_type_registry = _weakref.WeakValueDictionary()
+
+def _get_partitioned_type(header):
+    hsig = _hsig(header)
+    cls = _partitioned_type_registry.get(hsig)
+    if cls is None:
+        rcls = _rel(header)
+        dct = dict(rcls.__dict__)
+        name = (PartitionedRelation.__name__ + '(' +
+                rcls.__name__.split('(', 1)[1])
+        cls = type(name, (PartitionedRelation,), dct)
+        _partitioned_type_registry[hsig] = cls
+    return cls
+
+
+class _PartitionedRelations(_collections_abc.Mapping):
+
+    # The partitioned relations of a Database, so that they can be named in
+    # expressions.
+
+    def __init__(self, db):
+        self._db = db
+
+    def __getitem__(self, name):
+        if name not in self._db._partitioned:
+            raise KeyError(name)
+        return self._db[name]
+
+    def __iter__(self):
+        return iter(self._db._partitioned)
+
+    def __len__(self):
+        return len(self._db._partitioned)
+
+
+class _RelationCache:
+
+    # Keeps track of the committed relations of a Database that has a memory
+    # limit (or is loaded lazily, in which case limit is None), in least
+    # recently used order, and drops the rows of the least recently used ones
+    # when more than 'limit' rows are in memory.  A relation that a
+    # transaction is in the middle of committing is never dropped.  The key
+    # relations (_sys_key_<relname>) are cached the same way, as part of their
+    # relation.  An evicted relation remembers the version it had, so that if
+    # sqlite no longer holds that version when it is reloaded (which can
+    # happen if other processes share the database) a ConflictError is raised
+    # rather than returning the wrong rows.
+
+    def __init__(self, db, limit):
+        self.db = db
+        self.limit = limit
+        self.lock = _threading.RLock()
+        self.current = {}
+        self.resident = _collections.OrderedDict()
+        self.rows = 0
+        self.loads = 0
+        self.evictions = 0
+
+    def add(self, r):
+        with self.lock:
+            old = self.current.get(r.name)
+            if old is not None and old is not r:
+                old._cached = False
+                if self.resident.get(r.name) is old:
+                    del self.resident[r.name]
+                    self.rows -= len(old)
+            r._cached = True
+            self.current[r.name] = r
+            rows = r.__dict__['_rows']
+            if rows is not None and r.name not in self.resident:
+                self.resident[r.name] = r
+                self.rows += len(rows)
+            self._shrink()
+
+    def touch(self, r):
+        try:
+            self.resident.move_to_end(r.name)
+        except KeyError:
+            pass
+
+    def load(self, r):
+        name = r.name
+        relname = _versioned_name(name)
+        with self.db._storage_for(relname).reader() as con, con:
+            version = con.get_versions([relname]).get(relname, 0)
+            if version != r._evicted_version:
+                raise ConflictError([relname])
+            if name == relname:
+                loaded = con.relation(name)
+            else:
+                loaded = con.relation(relname, r.header)
+        with self.lock:
+            rows = r.__dict__['_rows']
+            if rows is None:
+                rows = r.__dict__['_rows'] = frozenset(loaded._rows)
+                self.loads += 1
+                if self.current.get(name) is r:
+                    self.resident[name] = r
+                    self.rows += len(rows)
+                    self._shrink()
+            return rows
+
+    def scan(self, r):
+        # Yield the rows of r from sqlite without keeping them in memory.
+        return _scan(self.db._storage_for(r.name), r.name, r.header,
+                     r._evicted_version)
+
+    def _shrink(self):
+        if self.limit is None or self.rows <= self.limit:
+            return
+        db = self.db
+        with db._commit_cond:
+            versions = db._published.versions
+            # Never evict the relation used most recently.
+            for name in list(self.resident)[:-1]:
+                if self.rows <= self.limit:
+                    break
+                r = self.resident[name]
+                relname = _versioned_name(name)
+                if name == relname:
+                    published = db._published.relations
+                else:
+                    published = db._published.system
+                if (db._claimed.get(relname, 0) != versions.get(relname, 0) or
+                        published.get(name) is not r):
+                    # Being committed, or not yet published.
+                    continue
+                del self.resident[name]
+                rows = r.__dict__['_rows']
+                r._evicted_version = versions.get(relname, 0)
+                r._evicted_len = len(rows)
+                r.__dict__['_rows'] = None
+                # Columns and orderings made from the rows would keep them
+                # in memory.
+                r._columns_ = r._orders_ = None
+                self.rows -= len(rows)
+                self.evictions += 1
+
+
+# Scans read a relation from sqlite a batch of rows at a time, in rowid order,
+# and only hold a reader (and its read transaction) while a batch is being
+# read, so a Stream that is never finished doesn't keep one from the pool.
+# Since each batch is read in its own sqlite transaction, the relation's
+# version is checked with every batch, and a commit to the relation in the
+# middle of a scan is a ConflictError rather than a mix of two versions.
+
+_SCAN_BATCH = 1000
+
+
+def _scan(storage, relname, header, version=None):
+    after = -2**63
+    while True:
+        with storage.reader() as con, con:
+            current = con.get_versions([relname]).get(relname, 0)
+            if version is None:
+                version = current
+            elif current != version:
+                raise ConflictError([relname])
+            after, rows = con.rows_after(relname, header, after, _SCAN_BATCH)
+        if not rows:
+            return
+        yield from rows
+
+
+# Concurrency control.  Each commit publishes a new _Published state, which
+# holds the committed relations, system relations, and the version number of
+# each relation.  A transaction reads from the state that was current when it
+# started, through _Snapshot maps that record which names it looks at, so
+# starting a transaction and reading never needs a lock.  At commit time the
+# versions of everything the transaction read or wrote are compared with the
+# latest claimed versions, and if any of them have moved on the transaction
+# is rolled back and ConflictError raised.
+
+_Published = _collections.namedtuple('_Published',
+                                     'relations system versions')
+
+def _versioned_name(name):
+    # Versions are kept per relation; a relation's key is part of it.
+    if name.startswith('_sys_key_'):
+        return name[len('_sys_key_'):]
+    return name
+
+
+class _Transaction:
+
+    def __init__(self, published, changelog):
+        self.published = published
+        self.read = set()
+        self.touched = set()
+        self.recording = True
+        # One dict of row deltas per nested transaction, if logging changes.
+        self.deltas = [{}] if changelog else None
+
+
+def _merge_delta(deltas, relname, inserted, deleted):
+    # Add the effect of deleting and then inserting some rows to the net
+    # (inserted, deleted) sets recorded for relname.
+    ins, dels = deltas.setdefault(relname, (set(), set()))
+    deleted = set(deleted)
+    gone = ins & deleted
+    ins -= gone
+    dels |= deleted - gone
+    inserted = set(inserted)
+    back = dels & inserted
+    dels -= back
+    ins |= inserted - back
+
+
+class _Snapshot(_collections_abc.Mapping):
+
+    def __init__(self, data, txn):
+        self._data = data
+        self._txn = txn
+
+    def __getitem__(self, name):
+        if self._txn.recording:
+            self._txn.read.add(name)
+        return self._data[name]
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __len__(self):
+        return len(self._data)
+
+
+class _Committed(_collections_abc.Mapping):
+
+    # The latest committed relations, as seen outside of any transaction.
+
+    def __init__(self, db):
+        self._db = db
+
+    def __getitem__(self, name):
+        return dict.__getitem__(self._db, name)
+
+    def __iter__(self):
+        return dict.__iter__(self._db)
+
+    def __len__(self):
+        return dict.__len__(self._db)
+
+
+# Snapshot files.  A snapshot holds the body of each relation as one pickled
+# list of values per attribute, so loading a relation takes one pickle.loads
+# call instead of one per cell.  An index at the end of the file records the
+# version and header each body was written from and where the body is; only
+# bodies whose version is still the current one are used.  The last eight
+# bytes of the file are the offset of the index.
+
+_SNAPSHOT_MAGIC = b'dinsd snapshot 1\n'
+
+
+def _trusted_row(rowtype, attrs):
+    # Build a row from values that don't need to be validated again.
+    row = rowtype.__new__(rowtype)
+    row.__dict__ = attrs
+    return row
+
+
+def _write_snapshot(path, published, scan):
+    # Write the snapshot file from the relations in published, and return its
+    # index.  The rows of a relation that has been evicted from memory are
+    # read with scan, at the version that was published; if that version has
+    # been replaced in the meantime the relation is left out, to be written
+    # with the next snapshot.
+    tmpfd, tmpfn = _tempfile.mkstemp(dir=_os.path.dirname(path) or '.',
+                                     prefix=_os.path.basename(path))
+    try:
+        with open(tmpfd, 'wb') as f:
+            f.write(_SNAPSHOT_MAGIC)
+            index = {}
+            for name, r in published.relations.items():
+                names = sorted(r.header)
+                body = r.__dict__.get('_rows', r)
+                try:
+                    rows = [vars(rw) for rw in
+                            (scan(r) if body is None else body)]
+                except ConflictError:
+                    continue
+                data = _pickle.dumps((names, [[d[n] for d in rows]
+                                                 for n in names]),
+                                     _pickle.HIGHEST_PROTOCOL)
+                index[name] = (published.versions.get(name, 0), r.header,
+                               f.tell(), len(data))
+                f.write(data)
+            offset = f.tell()
+            f.write(_pickle.dumps(index, _pickle.HIGHEST_PROTOCOL))
+            f.write(offset.to_bytes(8, 'big'))
+            f.flush()
+            _os.fsync(f.fileno())
+        _os.replace(tmpfn, path)
+    except BaseException:
+        _os.unlink(tmpfn)
+        raise
+    return index
+
+
+class _SnapshotReader:
+
+    def __init__(self, path):
+        self.index = {}
+        self._map = None
+        try:
+            with open(path, 'rb') as f:
+                self._map = _mmap.mmap(f.fileno(), 0, access=_mmap.ACCESS_READ)
+            if self._map[:len(_SNAPSHOT_MAGIC)] != _SNAPSHOT_MAGIC:
+                raise ValueError("not a dinsd snapshot")
+            offset = int.from_bytes(self._map[-8:], 'big')
+            self.index = _pickle.loads(self._map[offset:-8])
+        except (OSError, ValueError, _pickle.UnpicklingError, EOFError):
+            # No usable snapshot; everything is loaded from sqlite instead.
+            self.close()
+
+    def relation(self, name, version, header):
+        try:
+            v, h, offset, length = self.index[name]
+        except KeyError:
+            return None
+        if v != version or h != header:
+            return None
+        r = _rel(header)()
+        row = r.row
+        try:
+            names, columns = _pickle.loads(self._map[offset:offset+length])
+            r._rows.update(_trusted_row(row, dict(zip(names, values)))
+                           for values in zip(*columns))
+        except (_pickle.UnpicklingError, EOFError, ValueError, TypeError):
+            # A damaged body; the relation is loaded from sqlite instead.
+            return None
+        return r
+
+    def close(self):
+        self.index = {}
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+
+# Parallel preloading.  Worker processes each read a range of _PRELOAD_CHUNK
+# rows of a relation and decode it into a list of values per attribute, which
+# comes back to the Database in a single pickle.  Each worker also reports the
+# version of the relation it read; a relation whose version has changed since
+# the Database read the versions is loaded again the ordinary way.
+
+_PRELOAD_CHUNK = 20000
+
+
+def _preload_range(dbfn, relname, names, lo, hi):
+    con = _sqlite.connect('file:{}?mode=ro'.format(_urllib_parse.quote(dbfn)),
+                          uri=True, isolation_level=None)
+    try:
+        con.execute('begin')
+        version = con.execute('select "version" from "_relversions" '
+                                  'where "relname"=?', (relname,)).fetchone()
+        rows = con.execute('select {} from "{}" where rowid between ? and ?'
+                           .format(', '.join('"{}"'.format(n) for n in names),
+                                   relname),
+                           (lo, hi)).fetchall()
+        con.execute('commit')
+    finally:
+        con.close()
+    columns = [list(map(_Decoded().__getitem__, col)) for col in zip(*rows)]
+    return 0 if version is None else version[0], columns
+
+
+def _preload(con, dbfn, headers, versions, processes):
+    tasks = []
+    for name, header in headers.items():
+        names = sorted(header)
+        for lo, hi in con.rowid_ranges(name, _PRELOAD_CHUNK):
+            tasks.append((name, names, lo, hi))
+    loaded = {name: _rel(header)() for name, header in headers.items()}
+    with _futures.ProcessPoolExecutor(processes) as pool:
+        results = []
+        for name, names, lo, hi in tasks:
+            results.append((name, names, pool.submit(
+                                _preload_range, dbfn, name, names, lo, hi)))
+        for name, names, future in results:
+            r = loaded.get(name)
+            if r is None:
+                continue
+            try:
+                version, columns = future.result()
+            except Exception:
+                # For example a value whose type the workers can't import.
+                version = None
+            if version != versions.get(name, 0):
+                del loaded[name]
+                continue
+            row = r.row
+            r._rows.update(_trusted_row(row, dict(zip(names, values)))
+                           for values in zip(*columns))
+    return loaded
+
+
 class _DBCon(_threading.local):
 
-    def __init__(self, storage, debug_sql=False):
+    # Entering a _DBCon gives the current thread exclusive use of the shared
+    # writer connection, inside a savepoint.  Between begin and finish (the
+    # extent of an outermost Database transaction) the first write also
+    # starts an sqlite transaction and keeps the writer until finish, so that
+    # all the writes made by the Database transaction commit or roll back
+    # together.  Nested transactions get savepoints of their own, created
+    # when the first write inside them happens.
+
+    def __init__(self, storage, debug_sql=False, group=None):
         self.storage = storage
-        self.con = storage.new_con()
         self.debug_sql = debug_sql
+        self.group = group
+        self.active = False
+        self.pinned = False
+        self.depth = 0
+        self.marked = 0
+
+    def _acquire(self):
+        # Partitioned relations are stored by other storages, each with its
+        # own _DBCon, and a transaction may need the writers of several.
+        # They are always taken in the order of the group's list, so a
+        # transaction that needs a writer earlier in the list than one it
+        # already holds can't wait for it; it is treated as a conflict.
+        lock = self.storage.write_lock
+        if self.group is None or not self.group.holds_later(self):
+            lock.acquire()
+        elif not lock.acquire(blocking=False):
+            raise ConflictError(sorted(self.group.names(self)))
+
+    def begin(self):
+        self.active = True
+
+    def push(self):
+        self.depth += 1
+
+    def pop(self, commit):
+        if self.marked == self.depth:
+            writer = self.storage.writer
+            savepoint = '_dinsd_level{}'.format(self.depth)
+            if not commit:
+                writer.rollback_to(savepoint)
+            writer.release(savepoint)
+            self.marked -= 1
+        self.depth -= 1
+
+    def pin(self):
+        if self.active and not self.pinned:
+            self._acquire()
+            try:
+                self.storage.begin_transaction()
+            except BaseException:
+                self.storage.write_lock.release()
+                raise
+            self.pinned = True
+        if self.pinned:
+            while self.marked < self.depth:
+                self.marked += 1
+                self.storage.writer.savepoint(
+                    '_dinsd_level{}'.format(self.marked))
+
+    def finish(self, commit):
+        self.active = False
+        self.depth = self.marked = 0
+        if self.pinned:
+            self.pinned = False
+            self.storage.end_transaction(commit)
 
     def __enter__(self):
-        return self.con.__enter__()
+        storage = self.storage
+        if self.active and not self.pinned:
+            self._acquire()
+        else:
+            storage.write_lock.acquire()
+        try:
+            self.pin()
+            return storage.writer.__enter__()
+        except BaseException:
+            storage.write_lock.release()
+            raise
 
     def __exit__(self, *args, **kw):
-        self.con.__exit__(*args, **kw)
+        try:
+            self.storage.writer.__exit__(*args, **kw)
+        finally:
+            self.storage.write_lock.release()
 
     @property
     def debug_sql(self):
@@ -179,34 +940,290 @@ class _DBCon(_threading.local):
     @debug_sql.setter
     def debug_sql(self, value):
         self._debug_sql = value
-        if value is False:
-            callback = None
+        self.storage.set_trace(value)
+
+
+class _PartialCommit(Exception):
+
+    # Raised by _DBCons.finish when some of the storages of a transaction
+    # committed it and another failed to; error is what that one raised.
+
+    def __init__(self, error, committed):
+        super().__init__(error, committed)
+        self.error = error
+        self.committed = committed
+
+
+class _DBCons:
+
+    # The _DBCon of a Database's own storage (main) and those of the storages
+    # of its partitions, which all follow the Database's transactions.
+    # Operations on a relation go through the _DBCon that 'to' returns for
+    # its name; entering the _DBCons itself enters main.
+
+    def __init__(self, storage, debug_sql=False):
+        self.debug_sql_default = debug_sql
+        self.main = _DBCon(storage, debug_sql, self)
+        self.members = [self.main]
+        self._by_name = {}
+
+    def add(self, storage, relnames):
+        con = _DBCon(storage, self.debug_sql_default, self)
+        con.debug_sql = self.main.debug_sql
+        self.members.append(con)
+        for n in relnames:
+            self._by_name[n] = con
+        return con
+
+    def to(self, relname):
+        return self._by_name.get(_versioned_name(relname), self.main)
+
+    def names(self, con):
+        return [n for n, c in self._by_name.items() if c is con]
+
+    def holds_later(self, con):
+        # Whether this thread has pinned a member after con.
+        members = self.members
+        for m in members[members.index(con)+1:]:
+            if m.pinned:
+                return True
+        return False
+
+    def begin(self):
+        for m in self.members:
+            m.begin()
+
+    def push(self):
+        for m in self.members:
+            m.push()
+
+    def pop(self, commit):
+        for m in self.members:
+            m.pop(commit)
+
+    def pin(self, relnames=None):
+        # Pin the members for relnames (all of them if it is None), in order.
+        if relnames is None:
+            wanted = self.members
         else:
-            output = None if value is True else value
-            callback = lambda x, output=output: print(x, file=output)
-        self.con.set_trace_callback(callback)
+            wanted = {self.to(n) for n in relnames}
+        for m in self.members:
+            if m in wanted:
+                m.pin()
+
+    def finish(self, commit):
+        # Each storage commits separately; the first error is raised once
+        # they have all finished.  If some storages did commit, the error
+        # is raised as a _PartialCommit saying which.
+        error = None
+        committed = []
+        for m in self.members:
+            pinned = m.pinned
+            try:
+                m.finish(commit)
+            except BaseException as e:
+                if error is None:
+                    error = e
+            else:
+                if commit and pinned:
+                    committed.append(m)
+        if error is not None:
+            if committed:
+                raise _PartialCommit(error, committed)
+            raise error
 
+    def __enter__(self):
+        return self.main.__enter__()
 
-class Database(dict):
+    def __exit__(self, *args, **kw):
+        return self.main.__exit__(*args, **kw)
+
+    @property
+    def debug_sql(self):
+        return self.main.debug_sql
 
-    def __init__(self, fn, debug_sql=False):
+    @debug_sql.setter
+    def debug_sql(self, value):
+        for m in self.members:
+            m.debug_sql = value
+
+
+class Metrics:
+
+    """Counters and latency histograms of the work a Database does.
+
+    The timings, each a histogram of durations in seconds, are:
+
+        insert, delete  Executing the statements that write rows (one
+                        sample per batch of rows).
+        update          Executing the statements that update the versions.
+        select          Reading the rows of a relation, not counting
+                        unpickling them.
+        savepoint       Creating, releasing, and rolling back savepoints.
+        pickle_encode   Pickling the values of rows being written.
+        pickle_decode   Unpickling the values of rows being read.
+        sync            Executing the sqlite statement that commits, which
+                        is where sqlite writes and fsyncs its files.
+        commit          A dinsd transaction's whole commit, from checking
+                        for conflicts to publishing its changes.
+
+    The counters are rows_read, rows_written (which includes deleted rows),
+    commits, and conflicts.  The timings and counters are also kept per
+    relation for the row statements.  snapshot returns all of them; if hook
+    is set, it is also called with the name, the value (seconds for a timing,
+    the amount added for a counter), and the relation name (or None) of each
+    one as it is recorded.
+    """
+
+    # The upper bounds of the histogram buckets, in seconds.
+    buckets = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+    def __init__(self, hook=None):
+        self.hook = hook
+        self._lock = _threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._counters = _collections.Counter()
+            self._timings = {}
+            self._relations = _collections.defaultdict(_collections.Counter)
+
+    def count(self, name, n=1, relname=None):
+        with self._lock:
+            self._counters[name] += n
+            if relname is not None:
+                self._relations[relname][name] += n
+        if self.hook is not None:
+            self.hook(name, n, relname)
+
+    def timing(self, name, seconds, relname=None):
+        with self._lock:
+            h = self._timings.get(name)
+            if h is None:
+                h = self._timings[name] = [0, 0.0, 0.0,
+                                           [0] * (len(self.buckets) + 1)]
+            h[0] += 1
+            h[1] += seconds
+            h[2] = max(h[2], seconds)
+            h[3][_bisect.bisect_left(self.buckets, seconds)] += 1
+            if relname is not None:
+                r = self._relations[relname]
+                r[name] += 1
+                r[name + '_time'] += seconds
+        if self.hook is not None:
+            self.hook(name, seconds, relname)
+
+    def snapshot(self):
+        """Return a dict of the current values of all the metrics.
+
+        'counters' maps counter names to their values.  'timings' maps timing
+        names to dicts of the count of samples, their total and max, and
+        'buckets', a list of [upper bound, count] pairs (the last bound is
+        None).  'relations' maps relation names to dicts of their counters
+        and of the count (name) and total seconds (name_time) of their
+        timings.
+        """
+        with self._lock:
+            bounds = list(self.buckets) + [None]
+            return dict(
+                counters=dict(self._counters),
+                timings={n: dict(count=c, total=t, max=m,
+                                 buckets=[list(b) for b in zip(bounds, bs)])
+                         for n, (c, t, m, bs) in self._timings.items()},
+                relations={n: dict(c) for n, c in self._relations.items()})
+
+
+class _Database(dict):
+
+    # What the Database of every back end has in common: the committed
+    # relations held in memory, transactions and the checking of them for
+    # conflicts, and constraints, keys, and indexes.  A back end's Database
+    # opens its storage, passes it to __init__, and loads the relations.
+
+    def __init__(self, storage, debug_sql=False, changelog=False,
+                 memory_limit=None, lazy=False, snapshot_path=None,
+                 snapshot_interval=None, metrics=None):
         self._debug_sql = debug_sql
-        self._storage = _dumb_sqlite_persistence(fn)
+        self._snapshot_path = snapshot_path
+        self._snapshot_interval = snapshot_interval
+        self._snapshot_lock = _threading.Lock()
+        self._changelog = changelog
+        self._memory_limit = memory_limit
+        self._lazy = lazy
+        self.metrics = metrics
+        self._storage = storage
         self._init()
         self.r = _R(self)
-        with self._con as con:
-            con.initialize_sqlite_db_if_needed()
-            self.row_constraints.update(con.get_row_constraints())
-            for name, r in con.relations():
-                super().__setitem__(name, _get_persistent_type(r)(self, name, r))
+
+    def _storage_for(self, relname):
+        return self._partition_storages.get(_versioned_name(relname),
+                                            self._storage)
 
     def _init(self):
+        self._partitioned = {}
+        self._partition_storages = {}
         self.row_constraints = _collections.defaultdict(dict)
+        self._indexes = _collections.defaultdict(dict)
         self._system_relations = {}
         self._system_ns = _dinsd._NS(self._system_relations)
         self._constraints = {}
-        self._transaction_ns = _dinsd._NS(self, in_getitem=False)
-        self._con = _DBCon(self._storage, debug_sql=self._debug_sql)
+        self._transaction_ns = _dinsd._NS(_Committed(self), txn=None)
+        self._con = _DBCons(self._storage, debug_sql=self._debug_sql)
+        self._published = _Published({}, {}, {})
+        self._claimed = {}
+        self._commit_cond = _threading.Condition()
+        self._snapshot_versions = {}
+        self._commits_since_snapshot = 0
+        if self._memory_limit is None and not self._lazy:
+            self._cache = None
+        else:
+            self._cache = _RelationCache(self, self._memory_limit)
+
+    def _persistent(self, name, r):
+        return _get_persistent_type(r, self._cache is not None)(self, name, r)
+
+    def _add_loaded(self, name, r, keynames):
+        # Install r, just read from the store, as the committed value of name.
+        r = self._persistent(name, r)
+        super().__setitem__(name, r)
+        self._published.relations[name] = r
+        if keynames is not None:
+            self._install_key(name, r, keynames)
+        if self._cache is not None:
+            self._cache.add(r)
+            if keynames is not None:
+                keyname = '_sys_key_' + name
+                k = self._persistent(keyname, self._system_relations[keyname])
+                self._system_relations[keyname] = k
+                self._published.system[keyname] = k
+                self._cache.add(k)
+
+    def _unloaded(self, name, header, version, length):
+        # A committed relation whose rows have not been read from sqlite yet.
+        r = _get_persistent_type(_rel(header)(), True)(self, name)
+        r._evicted_version = version
+        r._evicted_len = length
+        r._rows = None
+        return r
+
+    def _add_unloaded(self, con, name, header, versions, keynames):
+        version = versions.get(name, 0)
+        r = self._unloaded(name, header, version, con.count(name))
+        super().__setitem__(name, r)
+        self._published.relations[name] = r
+        self._cache.add(r)
+        if keynames is not None:
+            # The key's values were unique when it was stored, so it has as
+            # many rows as the relation.
+            keyname = '_sys_key_' + name
+            k = self._unloaded(keyname, {n: header[n] for n in keynames},
+                               version, len(r))
+            self._system_relations[keyname] = k
+            self._published.system[keyname] = k
+            r.key = k.header
+            self._add_key_constraints(name)
+            self._cache.add(k)
 
     @property
     def debug_sql(self):
@@ -220,66 +1237,490 @@ class Database(dict):
         n = [_dinsd.ns.current]
         if not self.transactions:
             n.append(self)
+        if self._partitioned:
+            n.append(_PartitionedRelations(self))
         return _collections.ChainMap(self._system_ns.current, *n)
 
-    @_contextlib.contextmanager
+    def _split(self, partitioning, rows):
+        # Return a relation for each partition holding its rows from rows.
+        rtype = _rel(partitioning.header)
+        parts = [rtype() for i in range(len(partitioning))]
+        for rw in rows:
+            if rw._header_ != rtype.header:
+                raise TypeError("Type of row ({}) does not match type of "
+                                "relation ({})".format(rw._header_,
+                                                       rtype.header))
+            parts[partitioning.partition_of(rw)]._rows.add(rw)
+        return parts
+
+    def _partitions(self, relname):
+        return self._partitioned[relname].names(relname)
+
     def transaction(self):
+        return self._transaction(exclusive=False)
+
+    @_contextlib.contextmanager
+    def _transaction(self, exclusive):
+        # An exclusive transaction takes the writer before taking its snapshot,
+        # once every claimed change has been published.  Since no other
+        # transaction can commit changes without the writer, it can't
+        # conflict.
+        outermost = not self.transactions
+        if outermost:
+            self._con.begin()
+            while exclusive:
+                self._wait_for_commits()
+                self._con.pin()
+                if self._claimed == self._published.versions:
+                    break
+                self._con.finish(commit=False)
+                self._con.begin()
+            if self._storage.shared:
+                self._refresh()
+            txn = _Transaction(self._published, self._changelog)
+            self._transaction_ns.txn = txn
+            self._transaction_ns.current = _collections.ChainMap(
+                _Snapshot(txn.published.relations, txn))
+            self._system_ns.current = _collections.ChainMap(
+                _Snapshot(txn.published.system, txn))
+        else:
+            self._con.push()
+            txn = self._transaction_ns.txn
+            if txn.deltas is not None:
+                txn.deltas.append({})
         changes = {}
         self._transaction_ns.push(changes)
         _dinsd.ns.push(self._transaction_ns.current)
         system_changes = {}
         self._system_ns.push(system_changes)
+        completed = False
         try:
             yield
+            completed = True
         except Rollback:
-            return
+            pass
         finally:
             _dinsd.ns.pop()
             self._transaction_ns.pop()
             self._system_ns.pop()
+            if outermost:
+                self._transaction_ns.current = _collections.ChainMap(
+                    _Committed(self))
+                self._system_ns.current = _collections.ChainMap(
+                    self._system_relations)
+                if not completed:
+                    self._transaction_ns.txn = None
+                    self._con.finish(commit=False)
+            else:
+                self._con.pop(commit=completed)
+                if txn.deltas is not None:
+                    deltas = txn.deltas.pop()
+                    if completed:
+                        for name, (ins, dels) in deltas.items():
+                            _merge_delta(txn.deltas[-1], name, ins, dels)
+        if not completed:
+            return
         if self.transactions:
             self._transaction_ns.current.maps[0].update(changes)
             self._system_ns.current.maps[0].update(system_changes)
         else:
-            # These two operations also update the dicts the base chainmaps in
-            # the namespaces are wrapped around.
-            self._update_db_rels(changes)
+            try:
+                self._commit(txn, changes, system_changes)
+            finally:
+                self._transaction_ns.txn = None
+
+    def _commit(self, txn, changes, system_changes):
+        written = {_versioned_name(n) for n in
+                     changes.keys() | system_changes.keys() | txn.touched}
+        if not written:
+            self._con.finish(commit=True)
+            return
+        if self.metrics is None:
+            self._commit_changes(txn, changes, system_changes, written)
+            return
+        start = _time.perf_counter()
+        try:
+            self._commit_changes(txn, changes, system_changes, written)
+        except ConflictError:
+            self.metrics.count('conflicts')
+            raise
+        self.metrics.timing('commit', _time.perf_counter() - start)
+        self.metrics.count('commits')
+
+    def _commit_changes(self, txn, changes, system_changes, written):
+        read = {_versioned_name(n) for n in txn.read}
+        versions = txn.published.versions
+        # Changes are only claimed while holding the writer (or, for
+        # partitions, the writers of the storages being written), which is
+        # what makes exclusive transactions work.  In shared mode holding the
+        # writer also means holding the sqlite write lock, so the versions
+        # other processes have committed can't change while we check them.
+        try:
+            self._con.pin(written)
+            if self._storage.shared:
+                with self._con as con:
+                    stored = con.get_versions(written | read)
+            else:
+                stored = None
+        except BaseException:
+            self._con.finish(commit=False)
+            raise
+        with self._commit_cond:
+            stale = [n for n in written | read
+                       if self._claimed.get(n, 0) != versions.get(n, 0) or
+                          stored is not None and
+                          stored.get(n, 0) != versions.get(n, 0)]
+            if not stale:
+                # Claim the new versions now, so that no other transaction
+                # can commit a change to these relations while this one is
+                # being written.
+                for n in written:
+                    self._claimed[n] = versions.get(n, 0) + 1
+        if stale:
+            self._con.finish(commit=False)
+            raise ConflictError(sorted(stale))
+        try:
+            try:
+                new_versions = {}
+                for n in written:
+                    new_versions.setdefault(self._con.to(n), {})[n] = (
+                        self._claimed[n])
+                for dbcon, vs in new_versions.items():
+                    with dbcon as con:
+                        con.set_versions(vs)
+                updated = self._write_db_rels(changes)
+                if self._cache is not None:
+                    # Other transactions may still need the versions being
+                    # replaced, and once this commit is done they can no
+                    # longer be read back from sqlite.
+                    for n in written:
+                        for old in (txn.published.relations.get(n),
+                                    txn.published.system.get('_sys_key_' + n)):
+                            if old is not None:
+                                old._rows
+                if txn.deltas is not None:
+                    with self._con as con:
+                        con.log_changes(txn.deltas[0])
+            except BaseException:
+                self._con.finish(commit=False)
+                raise
+            # Only make the changes visible once they are durable.
+            self._con.finish(commit=True)
+        except BaseException as e:
+            reloaded = set()
+            try:
+                if isinstance(e, _PartialCommit):
+                    # The storages of some of the relations committed, so
+                    # what is on disk for those no longer matches what is
+                    # published.  Their new versions are still claimed, so
+                    # no other commit can touch them until they have been
+                    # reloaded (or ever, if reloading them fails).
+                    reloaded = {n for n in written
+                                  if self._con.to(n) in e.committed}
+                    self._reload(reloaded)
+            finally:
+                with self._commit_cond:
+                    for n in written - reloaded:
+                        if n in versions:
+                            self._claimed[n] = versions[n]
+                        else:
+                            del self._claimed[n]
+                    self._commit_cond.notify_all()
+            if isinstance(e, _PartialCommit):
+                raise e.error from None
+            raise
+        if self._cache is not None:
+            system_changes = {n: self._persistent(n, k)
+                              for n, k in system_changes.items()}
+        with self._commit_cond:
+            published = self._published
+            relations = dict(published.relations)
+            relations.update(updated)
+            system = dict(published.system)
+            system.update(system_changes)
+            new_versions = dict(published.versions)
+            new_versions.update((n, self._claimed[n]) for n in written)
+            for name, val in updated.items():
+                super().__setitem__(name, val)
             self._system_relations.update(system_changes)
+            self._published = _Published(relations, system, new_versions)
+            self._commits_since_snapshot += 1
+            snapshot_due = (self._snapshot_path is not None and
+                            self._snapshot_interval is not None and
+                            self._commits_since_snapshot >=
+                                self._snapshot_interval)
+            if snapshot_due:
+                self._commits_since_snapshot = 0
+            self._commit_cond.notify_all()
+        if self._cache is not None:
+            for val in updated.values():
+                self._cache.add(val)
+            for k in system_changes.values():
+                self._cache.add(k)
+        if snapshot_due:
+            # The commit has already been made, so a snapshot that can't be
+            # written mustn't make it look as though it failed.
+            try:
+                self.write_snapshot()
+            except Exception as exc:
+                _warnings.warn("writing snapshot failed: {!r}".format(exc),
+                               RuntimeWarning)
+
+    def run_transaction(self, func, *args, retries=10, **kw):
+        """Call func in a transaction, retrying it if it conflicts.
+
+        Return the value returned by the last call to func.  The retries are
+        run with the writer held from the start, so that they can't conflict
+        with anything else; if one nevertheless conflicts after 'retries'
+        retries, the ConflictError is raised.
+        """
+        for i in range(retries + 1):
+            try:
+                with self._transaction(exclusive=bool(i)):
+                    return func(*args, **kw)
+            except ConflictError:
+                if i == retries:
+                    raise
+
+    def _log_rows(self, relname, inserted=(), deleted=()):
+        txn = self._transaction_ns.txn
+        if txn.deltas is not None:
+            _merge_delta(txn.deltas[-1], relname, inserted, deleted)
+
+    def scan(self, relname, condition=None):
+        """Return a dinsd.external.Stream of the committed rows of relname.
+
+        The rows are read from sqlite as the Stream is iterated instead of
+        being loaded into memory, so that a relation too big to hold can be
+        fed to the operators in dinsd.external.  Changes made by a
+        transaction that has not yet committed are not seen.  If a change to
+        the relation is committed while it is being read, the Stream raises
+        ConflictError.  If condition is given, only the rows satisfying it
+        are returned; for a partitioned relation only the partitions that
+        can hold such rows are read.
+        """
+        if relname in self._partitioned:
+            names = self._partitions(relname)
+            if isinstance(condition, str):
+                names = [names[i] for i in
+                         self._partitioned[relname].prune(condition)]
+            header = self._partitioned[relname].header
+        else:
+            names = [relname]
+            header = self._published.relations[relname].header
+        if isinstance(condition, str):
+            c = compile(condition, '<scan>', 'eval')
+            condition = lambda r, c=c: eval(c, _expns, r._as_locals())
+        published = self._published
+        def rows():
+            for name in names:
+                if self._storage.dbfn == ':memory:':
+                    # Reading would hold the writer for as long as the Stream
+                    # lives.
+                    yield from published.relations[name]
+                    continue
+                yield from _scan(self._storage_for(name), name, header)
+        if condition is None:
+            return _external.Stream(header, rows())
+        return _external.Stream(header, filter(condition, rows()))
+
+    def write_snapshot(self):
+        """Write the snapshot file from the latest committed relations.
+
+        This is done automatically when the database is closed, and every
+        snapshot_interval commits if that is set.  Nothing is written if
+        no relation has changed since the snapshot file was last read or
+        written.
+        """
+        if self._snapshot_path is None:
+            raise ValueError("database was not opened with snapshot=True")
+        with self._snapshot_lock:
+            published = self._published
+            versions = {n: published.versions.get(n, 0)
+                        for n in published.relations}
+            if versions == self._snapshot_versions:
+                return
+            index = _write_snapshot(self._snapshot_path, published,
+                                    self._cache and self._cache.scan)
+            self._snapshot_versions = {n: v for n, (v, *rest)
+                                             in index.items()}
+
+    def memory_stats(self):
+        """Return a dict of statistics about the relations held in memory.
+
+        'rows' and 'relations' are the number of rows and relations currently
+        in memory.  With a memory limit, 'limit' is the limit, 'loads' is the
+        number of times a relation has been read back from sqlite, and
+        'evictions' the number of times one has been dropped from memory.
+        """
+        cache = self._cache
+        if cache is None:
+            rels = list(self._published.relations.values())
+            return dict(rows=sum(len(r) for r in rels), relations=len(rels),
+                        limit=None, loads=0, evictions=0)
+        with cache.lock:
+            return dict(rows=cache.rows, relations=len(cache.resident),
+                        limit=cache.limit, loads=cache.loads,
+                        evictions=cache.evictions)
+
+    def refresh(self):
+        """Reload any relations that other processes have changed.
+
+        This is done automatically at the start of each outermost
+        transaction when the database is shared; calling it directly brings
+        the relations seen outside of a transaction up to date.
+        """
+        if not self._storage.shared:
+            return
+        self._refresh()
+
+    def _refresh(self):
+        if not self._storage.changed():
+            return
+        with self._storage.reader() as con, con:
+            versions = con.get_versions()
+            known = self._published.versions
+            changed = [n for n, v in versions.items() if v > known.get(n, 0)]
+            if not changed:
+                return
+            loaded = self._read_stored(con, changed)
+        def wanted(name, current):
+            # Not if already up to date, or if one of our own commits of
+            # this relation is in progress.
+            return (versions[name] > current and
+                    self._claimed.get(name, 0) == current)
+        self._install_stored(loaded, versions, wanted)
+
+    def _reload(self, names):
+        # Publish the relations names as they are now stored.
+        loaded = {}
+        versions = {}
+        storages = _collections.defaultdict(list)
+        for name in names:
+            storages[self._storage_for(name)].append(name)
+        for storage, relnames in storages.items():
+            with storage.reader() as con, con:
+                versions.update(con.get_versions(relnames))
+                loaded.update(self._read_stored(con, relnames))
+        self._install_stored(loaded, versions, lambda name, current: True)
+
+    def _read_stored(self, con, names):
+        # Read the relations names, with their keys, row constraints, and
+        # indexes, from con.
+        loaded = {}
+        keys = con.get_keys()
+        row_constraints = con.get_row_constraints()
+        indexes = con.get_indexes()
+        for name in names:
+            loaded[name] = (con.relation(name), keys.get(name),
+                            row_constraints.get(name, {}),
+                            indexes.get(name, {}))
+        return loaded
+
+    def _install_stored(self, loaded, versions, wanted):
+        # Publish the relations in loaded, read by _read_stored, as the
+        # committed values of their names, along with their versions.
+        # wanted(name, current) is called with the published version of each
+        # while holding the commit lock, and only those it approves are
+        # installed.
+        refreshed = []
+        with self._commit_cond:
+            published = self._published
+            relations = dict(published.relations)
+            system = dict(published.system)
+            new_versions = dict(published.versions)
+            for name, (r, keynames, constraints, idx) in loaded.items():
+                if not wanted(name, published.versions.get(name, 0)):
+                    continue
+                r = relations[name] = self._persistent(name, r)
+                super().__setitem__(name, r)
+                refreshed.append(r)
+                self.row_constraints[name] = dict(constraints)
+                self._indexes[name] = {n: set(a) for n, a in idx.items()}
+                keyname = '_sys_key_' + name
+                if keynames is None:
+                    system.pop(keyname, None)
+                    self._system_relations.pop(keyname, None)
+                    self._constraints.pop('_key_' + name, None)
+                else:
+                    k = r >> keynames
+                    if self._cache is not None:
+                        k = self._persistent(keyname, k)
+                        refreshed.append(k)
+                    system[keyname] = self._system_relations[keyname] = k
+                    r.key = k.header
+                    self._add_key_constraints(name)
+                new_versions[name] = self._claimed[name] = versions[name]
+            self._published = _Published(relations, system, new_versions)
+            self._commit_cond.notify_all()
+        if self._cache is not None:
+            for r in refreshed:
+                self._cache.add(r)
+
+    def _wait_for_commits(self):
+        # Wait until all claimed changes have been published.
+        with self._commit_cond:
+            self._commit_cond.wait_for(
+                lambda: self._claimed == self._published.versions)
 
     @property
     def transactions(self):
         return len(self._transaction_ns) - 1
 
-    # Local Decorator.
+    # Local Decorator.  Inside a transaction, meth runs in a nested one, so
+    # that if it fails whatever it had already changed is undone, and a
+    # caller that catches the error can't go on to commit half of the change.
     def _transaction_required(meth):
         @_functools.wraps(meth)
         def wrapper(self, *args, **kw):
-            if self.transactions:
-                meth(self, *args, **kw)
-            else:
-                with self.transaction():
-                    meth(self, *args, **kw)
+            with self.transaction():
+                return meth(self, *args, **kw)
         return wrapper
 
-    def _update_db_rels(self, updated_rels):
+    def _write_db_rels(self, updated_rels):
+        # Write the changes to the persistent store and return the new
+        # persistent relations.
+        new_rels = {}
         for name, val in updated_rels.items():
             val_db = getattr(val, 'db', None)
             if val_db != self:
                 # We did not get here via insert, update, or delete, so we have
-                # to update the DB with the entire new value.
-                with self._con as con:
-                    if name not in self:
+                # to update the DB to match the new value.
+                old = super().get(name)
+                if old is None:
+                    key = getattr(val, 'key', None)
+                    with self._con.to(name) as con:
                         con.add_reltype(name, val.header)
-                    con.update_relation(name, val)
-                val = _get_persistent_type(val)(self, name, val)
-            super().__setitem__(name, val)
+                        con.insert_rows(name, sorted(val.header), val)
+                        if key is not None:
+                            con.set_key(name, sorted(key))
+                    self._log_rows(name, inserted=val._rows)
+                    val = self._persistent(name, val)
+                    val.key = key
+                else:
+                    val = self._write_changes(name, old, val)
+            new_rels[name] = val
+        return new_rels
+
+    def _write_changes(self, relname, old, val):
+        # Bring the stored relation from old to val by writing only the rows
+        # that differ, and return the new persistent relation.
+        names = sorted(val.header)
+        key = names if old.key is None else sorted(old.key)
+        deleted = old._rows - val._rows
+        inserted = val._rows - old._rows
+        with self._con.to(relname) as con:
+            con.delete_rows(relname, key, deleted)
+            con.insert_rows(relname, names, inserted)
+        self._log_rows(relname, inserted, deleted)
+        new = self._persistent(relname, val)
+        new.key = old.key
+        return new
 
     def __getitem__(self, name):
-        # XXX I wonder if there is a more elegant way to to do this.
-        if self._transaction_ns.in_getitem:
-            self._transaction_ns.in_getitem = False
-            return super().__getitem__(name)
-        self._transaction_ns.in_getitem = True
+        if name in self._partitioned:
+            return _get_partitioned_type(self._partitioned[name].header)(
+                        self, name)
         return self._transaction_ns.current[name]
 
     @_transaction_required
@@ -287,6 +1728,18 @@ class Database(dict):
         if not hasattr(val, 'header'):
             raise ValueError("Only relations may be stored in database, "
                 "not {}".format(type(val)))
+        if name in self._partitioned:
+            partitioning = self._partitioned[name]
+            if val.header != partitioning.header:
+                raise ValueError("header mismatch: a value of type {} cannot "
+                    "be assigned to a database relation of type {}".format(
+                        type(val), type(self[name])))
+            if isinstance(val, type):
+                raise ValueError("database relation type already set")
+            parts = self._split(partitioning, val)
+            for pname, part in zip(self._partitions(name), parts):
+                self[pname] = part
+            return
         attr = self.get(name)
         if attr is not None:
             if val.header != attr.header:
@@ -298,20 +1751,87 @@ class Database(dict):
         elif isinstance(val, type):
             val = val()
         # XXX Do we need to use the DB relation in _check_constraints?
-        self._check_constraints(name, val)
+        self._check_row_constraints(name, val)
+        current = self._transaction_ns.current.get(name)
         self._transaction_ns.current[name] = val
+        self._check_db_constraints()
+        txn = self._transaction_ns.txn
+        if (getattr(current, 'db', None) is self and
+                current is not txn.published.relations.get(name)):
+            # insert, update, or delete has already written this relation to
+            # the persistent store during this transaction, so the committed
+            # value no longer reflects what is stored.  Write the difference
+            # now rather than at commit time.
+            self._transaction_ns.current[name] = self._write_changes(
+                name, current, val)
 
-    def _insert_row(self, relname, rw):
-        with self._con as con:
-            con.insert_row(relname, rw)
-
-    def _update_row(self, relname, key_fields, changes):
-        with self._con as con:
-            con.update_row(relname, key_fields.__dict__, changes)
-
-    def _delete_row(self, relname, key_fields, rw):
-        with self._con as con:
-            con.delete_row(relname, key_fields.__dict__, rw)
+    @_transaction_required
+    def load(self, relname, rows, batch=10000):
+        """Insert rows (an iterable of rows of relname's type) into relname.
+
+        This is meant for loading a lot of rows, such as those of a Stream
+        read from a file.  Unlike insert, rows that are already in relname
+        are skipped, and the relation is only copied once: the rows are
+        checked and written a batch at a time, and added to the copy.  Return
+        the number of rows inserted.
+        """
+        loaded = {}
+        count = 0
+        chunk = []
+        for rw in rows:
+            chunk.append(rw)
+            if len(chunk) >= batch:
+                count += self._load_rows(loaded, relname, chunk)
+                chunk = []
+        if chunk:
+            count += self._load_rows(loaded, relname, chunk)
+        if loaded:
+            self._transaction_ns.current.update(loaded)
+            self._check_db_constraints()
+        return count
+
+    def _load_rows(self, loaded, relname, rows):
+        if relname in self._partitioned:
+            parts = self._split(self._partitioned[relname], rows)
+            return sum(self._load_rows(loaded, name, part)
+                       for name, part in zip(self._partitions(relname), parts)
+                       if part)
+        new = loaded.get(relname)
+        if new is None:
+            current = self[relname]
+            if getattr(current, 'db', None) is self:
+                new = current.copy()
+            else:
+                # Assigned in this transaction and not written yet; the rows
+                # are written with it when the transaction commits.
+                new = _rel(current.header)()
+                new._rows = set(current._rows)
+            loaded[relname] = new
+        added = _rel(new.header)()
+        for rw in rows:
+            if rw._header_ != new.header:
+                raise TypeError("Type of inserted row ({}) does not match "
+                                "type of relation ({})".format(rw._header_,
+                                                               new.header))
+            if rw not in new._rows:
+                added._rows.add(rw)
+        if not added:
+            return 0
+        self._check_row_constraints(relname, added)
+        self._extend_key(relname, added)
+        if getattr(new, 'db', None) is self:
+            self._insert_rows(relname, added)
+            self._log_rows(relname, inserted=added._rows)
+        new._rows |= added._rows
+        return len(added)
+
+    def _insert_rows(self, relname, rows):
+        with self._con.to(relname) as con:
+            con.insert_rows(relname, sorted(rows.header), rows)
+
+    def _delete_rows(self, relname, key, rows):
+        with self._con.to(relname) as con:
+            con.delete_rows(relname, sorted(key), rows)
 
     def __repr__(self):
         return "{}({{{}}})".format(
@@ -326,19 +1846,6 @@ class Database(dict):
         self._check_row_constraints(relname, r)
         self._check_db_constraints()
 
-    def _check_row_constraint(self, relname, r, rw):
-        row_validator = ' and '.join(
-                           "({})".format(v)
-                           for v in self.row_constraints[relname].values())
-        if row_validator:
-            with _dinsd.ns(self._system_ns.current):
-                if not eval(row_validator, _expns, rw._as_locals()):
-                    # find first failing constraint to put in error message
-                    for c, exp in sorted(self.row_constraints[relname].items()):
-                        if not eval(exp, _expns, rw._as_locals()):
-                            raise RowConstraintError(relname, c, exp, rw)
-                    raise AssertionError("Expected failure did not happen")
-
     def _check_row_constraints(self, relname, r):
         row_validator = ' and '.join(
                            "({})".format(v)
@@ -357,6 +1864,18 @@ class Database(dict):
                     raise AssertionError("Expected failure did not happen")
 
     def _check_db_constraints(self):
+        # The key constraints look at every keyed relation, but they only
+        # check that each relation is consistent with its own key, which is
+        # up to the transactions that change it.  So these lookups don't count
+        # as reads when checking for conflicts.
+        txn = self._transaction_ns.txn
+        txn.recording = False
+        try:
+            self._check_db_constraint_loop()
+        finally:
+            txn.recording = True
+
+    def _check_db_constraint_loop(self):
         for i in range(10):
             done = True
             for name, (constraint, fixer) in self._constraints.items():
@@ -383,17 +1902,28 @@ class Database(dict):
         # two things: makes the relations inaccessible after a close, and
         # breaks the reference cycle between the Database object and the
         # relations.
+        if self._snapshot_path is not None:
+            self.write_snapshot()
+        storages = list(self._partition_storages.values())
         self._init()
         for r in self.values():
             r._rows = set()
             r.__class__ = DisconnectedPersistentRelation
         self.clear()
+        for storage in storages:
+            storage.close()
+        self._storage.close()
 
     # Row Constraints
 
     @_transaction_required
     def constrain_rows(self, relname, **kw):
+        if relname in self._partitioned:
+            for name in self._partitions(relname):
+                self.constrain_rows(name, **kw)
+            return
         r = self[relname]
+        self._transaction_ns.txn.touched.add(relname)
         existing = self.row_constraints[relname].copy()
         self.row_constraints[relname].update(kw)
         try:
@@ -401,24 +1931,57 @@ class Database(dict):
         except Exception:
             self.row_constraints[relname] = existing
             raise
-        with self._con as con:
+        with self._con.to(relname) as con:
             con.add_row_constraints(relname, kw)
 
+    @_transaction_required
     def remove_row_constraints(self, relname, *args):
+        if relname in self._partitioned:
+            for name in self._partitions(relname):
+                self.remove_row_constraints(name, *args)
+            return
         self[relname]          # Key Error if no such rel.
+        self._transaction_ns.txn.touched.add(relname)
         for arg in args:
             del self.row_constraints[relname][arg]
-        with self._con as con:
+        with self._con.to(relname) as con:
             con.del_row_constraints(relname, args)
 
     # Key Constraints
 
     @_transaction_required
     def set_key(self, relname, keynames):
+        if relname in self._partitioned:
+            # Rows with equal key values must be in the same partition for the
+            # partitions' keys to make a key for the whole relation.
+            attrnames = self._partitioned[relname].attrnames
+            if not set(attrnames) <= set(keynames):
+                raise ValueError("the key of {} must include its partitioning "
+                                 "attributes {}".format(relname, attrnames))
+            for name in self._partitions(relname):
+                self.set_key(name, keynames)
+            return
         r = self._transaction_ns.current[relname]
         r._validate_attr_names(keynames)
-        k = self._system_ns.current['_sys_key_'+relname] = r >> keynames
+        self._transaction_ns.txn.touched.add(relname)
+        self._install_key(relname, r, keynames)
+        # A relation created in this transaction does not have a table yet;
+        # its key is stored along with it when the transaction commits.
+        if relname in self:
+            with self._con.to(relname) as con:
+                con.set_key(relname, sorted(keynames))
+
+    def _install_key(self, relname, r, keynames):
+        k = r >> keynames
+        if len(k) != len(r):
+            raise ConstraintError("{} is not a key for {}: its values are "
+                                  "not unique".format(sorted(keynames),
+                                                      relname))
+        self._system_ns.current['_sys_key_'+relname] = k
         r.key = k.header
+        self._add_key_constraints(relname)
+
+    def _add_key_constraints(self, relname):
         # XXX I think these need to be transactionized, too.
         self.row_constraints[relname]['_sys_key_'+relname] = (
             "_row_ in {relname} or "
@@ -442,43 +2005,581 @@ class Database(dict):
         self._system_ns.current[keyname] = new_key
         return True
 
+    def _extend_key(self, relname, rows):
+        keyname = '_sys_key_'+relname
+        key = self._system_ns.current.get(keyname)
+        if key is None:
+            return
+        # The row constraint has already checked the new rows against the
+        # existing key, so we only need to look for duplicates among the rows
+        # being added.
+        new_key = rows >> key.header.keys()
+        if len(new_key) != len(rows):
+            raise ConstraintError("rows inserted into {} contain duplicate "
+                                  "key values".format(relname))
+        self._system_ns.current[keyname] = key | new_key
+
+    def _remove_key(self, relname, rows):
+        keyname = '_sys_key_'+relname
+        key = self._system_ns.current.get(keyname)
+        if key is not None:
+            self._system_ns.current[keyname] = key - (rows >>
+                                                      key.header.keys())
+
     def key(self, relname):
+        if relname in self._partitioned:
+            relname = self._partitions(relname)[0]
         return set(self._system_ns.current['_sys_key_'+relname].header.keys())
 
+    # Indexes.  Changing a relation's indexes (like its key or its row
+    # constraints) bumps its version, so that other processes sharing the
+    # database pick the change up when they refresh.
+
+    @_transaction_required
+    def create_index(self, relname, indexname, attrnames):
+        if relname in self._partitioned:
+            for name in self._partitions(relname):
+                self.create_index(name, indexname, attrnames)
+            return
+        if relname not in self:
+            raise KeyError(relname)
+        self[relname]._validate_attr_names(attrnames)
+        if indexname in self._indexes[relname]:
+            raise ValueError("{} already has an index named {!r}".format(
+                                relname, indexname))
+        self._transaction_ns.txn.touched.add(relname)
+        with self._con.to(relname) as con:
+            con.create_index(relname, indexname, sorted(attrnames))
+        self._indexes[relname][indexname] = set(attrnames)
+
+    @_transaction_required
+    def drop_index(self, relname, indexname):
+        if relname in self._partitioned:
+            for name in self._partitions(relname):
+                self.drop_index(name, indexname)
+            return
+        del self._indexes[relname][indexname]
+        self._transaction_ns.txn.touched.add(relname)
+        with self._con.to(relname) as con:
+            con.drop_index(relname, indexname)
+
+    def indexes(self, relname):
+        if relname in self._partitioned:
+            relname = self._partitions(relname)[0]
+        self[relname]          # Key Error if no such rel.
+        return {n: set(a) for n, a in self._indexes[relname].items()}
+
+
+class Database(_Database):
+
+    def __init__(self, fn, debug_sql=False, wal=False, synchronous=None,
+                 readers=4, group_commit=None, group_commit_size=64,
+                 changelog=False, memory_limit=None, shared=False,
+                 snapshot=False, snapshot_interval=None, lazy=False,
+                 preload_processes=None, metrics=False):
+        if memory_limit is not None and fn == ':memory:':
+            raise ValueError("an in-memory database can't have a memory limit")
+        if lazy and fn == ':memory:':
+            raise ValueError("an in-memory database can't be loaded lazily")
+        if preload_processes is not None and fn == ':memory:':
+            raise ValueError("an in-memory database can't be preloaded")
+        if snapshot and fn == ':memory:':
+            raise ValueError("an in-memory database can't have a snapshot")
+        metrics = Metrics() if metrics else None
+        self._storage_options = dict(wal=wal, synchronous=synchronous,
+                                     readers=readers,
+                                     group_commit=group_commit,
+                                     group_commit_size=group_commit_size,
+                                     metrics=metrics)
+        super().__init__(
+            _dumb_sqlite_persistence(fn, shared=shared,
+                                     **self._storage_options),
+            debug_sql=debug_sql, changelog=changelog,
+            memory_limit=memory_limit, lazy=lazy,
+            snapshot_path=fn + '.snapshot' if snapshot else None,
+            snapshot_interval=snapshot_interval, metrics=metrics)
+        with self._con as con:
+            con.initialize_sqlite_db_if_needed()
+        if shared:
+            self._storage.changed()
+        with self._storage.reader() as con, con:
+            versions = con.get_versions()
+            self._claimed = dict(versions)
+            self._published = _Published({}, {}, versions)
+            self.row_constraints.update(con.get_row_constraints())
+            keys = con.get_keys()
+            snap = None
+            if self._snapshot_path is not None:
+                snap = _SnapshotReader(self._snapshot_path)
+                self._snapshot_versions = {n: v for n, (v, *rest)
+                                                 in snap.index.items()}
+            headers = con.headers()
+            preloaded = {}
+            if preload_processes is not None and not lazy:
+                if snap is not None:
+                    for name, header in headers.items():
+                        r = snap.relation(name, versions.get(name, 0), header)
+                        if r is not None:
+                            preloaded[name] = r
+                preloaded.update(_preload(
+                    con, fn, {n: h for n, h in headers.items()
+                                   if n not in preloaded},
+                    versions, preload_processes))
+            # Otherwise relations are loaded one at a time, so that with a
+            # memory limit the whole database never needs to be in memory at
+            # once.
+            for name, header in headers.items():
+                if lazy:
+                    self._add_unloaded(con, name, header, versions,
+                                       keys.get(name))
+                    continue
+                r = preloaded.pop(name, None)
+                if r is None and snap is not None:
+                    # Bodies that have not changed since the snapshot was
+                    # written come from the snapshot.
+                    r = snap.relation(name, versions.get(name, 0), header)
+                if r is None:
+                    r = con.relation(name, header)
+                self._add_loaded(name, r, keys.get(name))
+            self._indexes.update(con.get_indexes())
+            missing = []
+            for relname, partitioning in con.get_partitionings().items():
+                missing.extend(self._open_partitions(relname, partitioning,
+                                                     versions, snap))
+            if snap is not None:
+                snap.close()
+        self._published = _Published(dict(super().items()),
+                                     dict(self._system_relations), versions)
+        if missing:
+            # We died while creating a partitioned relation.
+            with self.transaction():
+                for name, header in missing:
+                    self[name] = _rel(header)()
+
+    def _open_partitions(self, relname, partitioning, versions, snap=None):
+        # Load the partitions of relname from their storages, and return the
+        # (name, header) of any that don't exist yet.
+        self._partitioned[relname] = partitioning
+        header = partitioning.header
+        missing = []
+        for i, name in enumerate(partitioning.names(relname)):
+            storage = self._add_partition_storage(relname, i, name)
+            with storage.reader() as con, con:
+                if name not in con.headers():
+                    missing.append((name, header))
+                    continue
+                stored = con.get_versions()
+                versions.update(stored)
+                self._claimed.update(stored)
+                self.row_constraints.update(con.get_row_constraints())
+                keynames = con.get_keys().get(name)
+                if self._lazy:
+                    self._add_unloaded(con, name, header, versions, keynames)
+                else:
+                    r = None
+                    if snap is not None:
+                        r = snap.relation(name, versions.get(name, 0), header)
+                    if r is None:
+                        r = con.relation(name, header)
+                    self._add_loaded(name, r, keynames)
+                self._indexes.update(con.get_indexes())
+        return missing
+
+    def _add_partition_storage(self, relname, i, name):
+        storage = _dumb_sqlite_persistence(
+                        '{}.{}.{}'.format(self._storage.dbfn, relname, i),
+                        **self._storage_options)
+        self._partition_storages[name] = storage
+        with self._con.add(storage, [name]) as con:
+            con.initialize_sqlite_db_if_needed()
+        return storage
+
+    def partition(self, relname, r, attrnames, shards=None, ranges=None):
+        """Create relname as a relation partitioned on attrnames.
+
+        r is the relation's type, or a relation whose rows become its initial
+        value.  Exactly one of shards (for hash partitioning) or ranges (for
+        range partitioning) must be given, as described in
+        dinsd.partitioning.  Each partition is a relation named
+        relname__<n>, stored in a file of its own (the database file name plus
+        '.<relname>.<n>'), so that transactions changing different partitions
+        commit in parallel.  A transaction that changes several partitions
+        commits each of them separately, so if the program dies while it is
+        committing, or a partition fails to commit, some of its changes may
+        survive and others not.  After such a failure the partitions that
+        did commit are reloaded from their files.
+        """
+        if self.transactions:
+            raise ValueError("can't partition a relation inside a transaction")
+        if self._storage.dbfn == ':memory:':
+            raise ValueError("an in-memory database can't have partitions")
+        if self._storage.shared or self._changelog:
+            raise ValueError("partitions can't be used with shared=True "
+                             "or changelog=True")
+        partitioning = _partitioning.Partitioning(r.header, attrnames,
+                                                  shards=shards, ranges=ranges)
+        names = partitioning.names(relname)
+        for name in [relname] + names:
+            if name in self or name in self._partitioned:
+                raise ValueError("{!r} is already in the database".format(
+                                    name))
+        # The partitioning is recorded first, so that if we die before the
+        # partitions are all created, the rest are created when the database
+        # is next opened.
+        with self._con as con:
+            con.add_partitioning(relname, partitioning)
+        self._partitioned[relname] = partitioning
+        for i, name in enumerate(names):
+            self._add_partition_storage(relname, i, name)
+        parts = self._split(partitioning, r() if isinstance(r, type) else r)
+        with self.transaction():
+            for name, part in zip(names, parts):
+                self[name] = part
+
+    def partitioning(self, relname):
+        """Return the Partitioning of relname, or None if it has none."""
+        return self._partitioned.get(relname)
+
+    def changes(self, since=0):
+        """Iterate over the changes logged by commits after 'since'.
+
+        Each change is a tuple (seq, relname, inserted, deleted), where
+        inserted and deleted are relations holding the rows that the commit
+        numbered seq inserted into or deleted from relname.  Sequence numbers
+        increase with each commit; passing the last one seen as 'since' picks
+        up where a previous iteration left off.  Changes are only logged if
+        the database was opened with changelog=True.
+        """
+        headers = {}
+        while True:
+            with self._storage.reader() as con, con:
+                batch = con.get_changes(since, 100)
+                for seq, deltas in batch:
+                    for relname in deltas.keys() - headers.keys():
+                        headers[relname] = _rel(con.header(relname))
+            if not batch:
+                return
+            for seq, deltas in batch:
+                for relname, (inserted, deleted) in sorted(deltas.items()):
+                    rtype = headers[relname]
+                    ins, dels = rtype(), rtype()
+                    ins._rows = {ins.row(d) for d in inserted}
+                    dels._rows = {dels.row(d) for d in deleted}
+                    yield seq, relname, ins, dels
+            since = batch[-1][0]
+
+    def discard_changes(self, upto):
+        """Delete the logged changes with sequence numbers up to 'upto'."""
+        with self._con as con:
+            con.discard_changes(upto)
+
 
 
 #
 # Dumb persistence infrastructure using sqlite.
 #
 
-import sys
+_synchronous_levels = {'off', 'normal', 'full', 'extra'}
+
+
+class _CommitGroup:
+
+    def __init__(self):
+        self.members = 0
+        self.full = _threading.Event()
+        self.done = _threading.Event()
+        self.error = None
+
+
 class _dumb_sqlite_persistence:
 
-    def __init__(self, fn):
+    def __init__(self, fn, wal=False, synchronous=None, readers=4,
+                 group_commit=None, group_commit_size=64, shared=False,
+                 metrics=None):
+        if synchronous is not None and synchronous not in _synchronous_levels:
+            raise ValueError("synchronous must be one of {}, not {!r}".format(
+                                sorted(_synchronous_levels), synchronous))
+        if shared and fn == ':memory:':
+            raise ValueError("an in-memory database can't be shared")
         self.dbfn = fn
+        self.wal = wal
+        self.synchronous = synchronous
+        self.write_lock = _threading.RLock()
+        self._writer = None
+        self._readers = []
+        self._reader_slots = _threading.BoundedSemaphore(readers)
+        self._pool_lock = _threading.Lock()
+        self._trace = _threading.local()
+        self._tracing = False
+        self.group_commit = group_commit
+        self.group_commit_size = group_commit_size
+        self._group = None
+        self.shared = shared
+        self._watcher = None
+        self._watch_lock = _threading.Lock()
+        self._data_version = None
+        self.metrics = metrics
+
+    def _connect(self, readonly=False):
+        if readonly:
+            con = _sqlite.connect(
+                'file:{}?mode=ro'.format(_urllib_parse.quote(self.dbfn)),
+                uri=True, isolation_level=None, check_same_thread=False)
+        else:
+            con = _sqlite.connect(self.dbfn, isolation_level=None,
+                                  check_same_thread=False)
+        if self._tracing:
+            con.set_trace_callback(self._trace_sql)
+        return _dumb_sqlite_connection(con, self.metrics)
+
+    @property
+    def writer(self):
+        if self._writer is None:
+            with self.write_lock:
+                if self._writer is None:
+                    writer = self._connect()
+                    if self.wal:
+                        writer.con.execute('PRAGMA journal_mode = WAL')
+                    if self.synchronous is not None:
+                        writer.con.execute('PRAGMA synchronous = {}'.format(
+                                                self.synchronous))
+                    self._writer = writer
+        return self._writer
+
+    @_contextlib.contextmanager
+    def reader(self):
+        if self.dbfn == ':memory:':
+            # Other connections can't see an in-memory database.
+            with self.write_lock:
+                yield self.writer
+            return
+        with self._reader_slots:
+            with self._pool_lock:
+                con = self._readers.pop() if self._readers else None
+            if con is None:
+                con = self._connect(readonly=True)
+            try:
+                yield con
+            finally:
+                with self._pool_lock:
+                    self._readers.append(con)
+
+    def changed(self):
+        # Report whether any other connection has committed since the last
+        # call.  sqlite's data_version only changes when some other
+        # connection commits, so we keep one connection just for asking.
+        with self._watch_lock:
+            if self._watcher is None:
+                self._watcher = self._connect(readonly=True)
+            version = self._watcher.con.execute(
+                            'PRAGMA data_version').fetchone()[0]
+            changed = version != self._data_version
+            self._data_version = version
+        return changed
+
+    # Transactions.  These are called with the write lock held, and
+    # end_transaction releases it.  Without group commit each transaction is
+    # its own sqlite transaction.  With group commit the first transaction
+    # starts an sqlite transaction, each transaction becomes a savepoint inside
+    # it, and the first transaction to commit into the group waits for the
+    # group to fill (or for the time to run out) and then commits it for
+    # everyone.
+
+    # In shared mode the sqlite transaction is begun immediately, so that
+    # the sqlite write lock is held from the first write until the commit.
+
+    def begin_transaction(self):
+        cur = self.writer._cursor
+        begin = 'begin immediate' if self.shared else 'begin'
+        if self.group_commit is not None:
+            if self._group is None:
+                cur.execute(begin)
+                self._group = _CommitGroup()
+        elif self.shared:
+            cur.execute(begin)
+        cur.execute('savepoint _dinsd_transaction')
+
+    def end_transaction(self, commit):
+        # Whether this transaction started the group, and so commits it when
+        # the window closes.  It must be decided under the lock: once the lock
+        # is released another transaction may join and change members.
+        leader = False
+        try:
+            cur = self.writer._cursor
+            if not commit:
+                cur.execute('rollback to _dinsd_transaction')
+            group = self._group
+            if group is None and not self.shared:
+                # Releasing the savepoint commits.
+                self._sync(cur, 'release _dinsd_transaction')
+                return
+            cur.execute('release _dinsd_transaction')
+            if group is None:
+                try:
+                    self._sync(cur, 'commit')
+                except Exception:
+                    self.writer.con.rollback()
+                    raise
+                return
+            if commit:
+                group.members += 1
+                leader = group.members == 1
+                if group.members >= self.group_commit_size:
+                    group.full.set()
+            elif not group.members:
+                # Nothing to wait for, so don't hold the sqlite lock.
+                self._commit_group()
+                return
+        finally:
+            self.write_lock.release()
+        if not commit:
+            return
+        if leader:
+            group.full.wait(self.group_commit)
+            with self.write_lock:
+                if self._group is group:
+                    self._commit_group()
+        group.done.wait()
+        if group.error is not None:
+            raise group.error
+
+    def _commit_group(self):
+        group, self._group = self._group, None
+        try:
+            self._sync(self.writer._cursor, 'commit')
+        except Exception as e:
+            group.error = e
+            self.writer.con.rollback()
+        group.done.set()
+
+    def _sync(self, cur, sql):
+        if self.metrics is None:
+            cur.execute(sql)
+            return
+        start = _time.perf_counter()
+        cur.execute(sql)
+        self.metrics.timing('sync', _time.perf_counter() - start)
 
-    def new_con(self, debug_sql=False):
-        con = _sqlite.connect(self.dbfn, isolation_level=None)
+    def close(self):
+        with self.write_lock:
+            if self._group is not None:
+                self._commit_group()
+            if self._writer is not None:
+                self._writer.con.close()
+                self._writer = None
+        with self._watch_lock:
+            if self._watcher is not None:
+                self._watcher.con.close()
+                self._watcher = None
+        with self._pool_lock:
+            for con in self._readers:
+                con.con.close()
+            self._readers = []
+
+    # SQL tracing is per-thread, but the connections are shared, so we install
+    # a single callback that looks up where the current thread wants its
+    # output to go.  We don't install it until someone turns tracing on.
+
+    def set_trace(self, debug_sql):
+        self._trace.debug_sql = debug_sql
+        if debug_sql and not self._tracing:
+            self._tracing = True
+            with self._pool_lock:
+                cons = list(self._readers)
+            if self._writer is not None:
+                cons.append(self._writer)
+            for con in cons:
+                con.set_trace_callback(self._trace_sql)
+
+    def _trace_sql(self, sql):
+        debug_sql = getattr(self._trace, 'debug_sql', False)
         if debug_sql:
-            outfile = None if debug_sql is True else debug_sql
-            con.set_trace_callback(lambda x: print(x, file=outfile))
-        return _dumb_sqlite_connection(con)
+            print(sql, file=None if debug_sql is True else debug_sql)
+
+
+class _Decoded(dict):
+
+    # The decoded values of a column, by their pickles.  A value that appears
+    # over and over (as the values of columns with few distinct values do) is
+    # unpickled only once, and all the rows share the one object.  Only the
+    # first _DECODE_MEMO_SIZE distinct values are remembered, and only if
+    # their pickles are no longer than _DECODE_MEMO_LEN bytes.
+
+    def __missing__(self, pickled):
+        value = _pickle.loads(pickled)
+        if len(self) < _DECODE_MEMO_SIZE and len(pickled) <= _DECODE_MEMO_LEN:
+            self[pickled] = value
+        return value
+
+_DECODE_MEMO_SIZE = 1000
+_DECODE_MEMO_LEN = 256
 
 
 class _dumb_sqlite_connection:
 
-    def __init__(self, con):
+    def __init__(self, con, metrics=None):
         self.con = con
+        self._cursor = con.cursor()
+        self._statements = {}
+        self.metrics = metrics
 
     def __enter__(self):
-        self.con.cursor().execute("savepoint _dinsd")
+        self._savepoint_sql("savepoint _dinsd")
         return self
 
     def __exit__(self, exc_type, exc_info, tb):
-        if exc_type is None:
-            self.con.cursor().execute("release _dinsd")
+        if exc_type is not None:
+            self._savepoint_sql("rollback to _dinsd")
+        self._savepoint_sql("release _dinsd")
+
+    def savepoint(self, name):
+        self._savepoint_sql('savepoint ' + name)
+
+    def rollback_to(self, name):
+        self._savepoint_sql('rollback to ' + name)
+
+    def release(self, name):
+        self._savepoint_sql('release ' + name)
+
+    def _savepoint_sql(self, sql):
+        if self.metrics is None:
+            self._cursor.execute(sql)
+            return
+        start = _time.perf_counter()
+        self._cursor.execute(sql)
+        self.metrics.timing('savepoint', _time.perf_counter() - start)
+
+    # Per-row write statements are built once per relation, operation, and
+    # set of columns, and each gets its own cursor.  Always passing sqlite the
+    # same string object also lets it reuse its prepared statement.
+
+    def _statement(self, name, op, names):
+        key = (name, op, tuple(names))
+        try:
+            return self._statements[key]
+        except KeyError:
+            pass
+        quoted = ['"{}"'.format(n) for n in names]
+        if op == 'insert':
+            sql = 'insert into "{}" ({}) values ({})'.format(
+                    name, ', '.join(quoted), ', '.join(['?'] * len(names)))
+        elif op == 'delete':
+            sql = 'delete from "{}" where {}'.format(
+                    name, ' and '.join(n + '=?' for n in quoted))
+        else:
+            raise ValueError("Unknown statement type {!r}".format(op))
+        dumps = _pickle.dumps
+        getter = _operator.attrgetter(*names)
+        if len(names) == 1:
+            params = lambda rw: (dumps(getter(rw)),)
         else:
-            self.con.cursor().execute("rollback to _dinsd")
+            params = lambda rw: [dumps(v) for v in getter(rw)]
+        stmt = self._statements[key] = (self.con.cursor(), sql, params)
+        return stmt
+
+    def _invalidate_statements(self, name):
+        for key in [k for k in self._statements if k[0] == name]:
+            del self._statements[key]
 
     def set_trace_callback(self, callback):
         self.con.set_trace_callback(callback)
@@ -509,8 +2610,38 @@ class _dumb_sqlite_connection:
         # This is a minor performance thing and not really required.
         c.execute('create index if not exists "_row_constraints_relname_index" '
                     'on "_row_constraints" ("relname")')
+        c.execute('create table if not exists "_keys" ('
+                    '"relname" varchar not null '
+                        'constraint "_keys_fkey" '
+                        'references _relnames ("relname") '
+                        'on delete cascade,'
+                    '"attrname" varchar not null, '
+                    'primary key ("relname", "attrname")'
+                    ') ')
+        c.execute('create table if not exists "_relversions" ('
+                    '"relname" varchar primary key, '
+                    '"version" integer not null'
+                    ') ')
+        c.execute('create table if not exists "_changelog" ('
+                    '"seq" integer primary key autoincrement, '
+                    '"changes" blob not null'
+                    ') ')
+        c.execute('create table if not exists "_indexes" ('
+                    '"relname" varchar not null '
+                        'constraint "_indexes_fkey" '
+                        'references _relnames ("relname") '
+                        'on delete cascade,'
+                    '"indexname" varchar not null, '
+                    '"attrname" varchar not null, '
+                    'primary key ("relname", "indexname", "attrname")'
+                    ') ')
+        c.execute('create table if not exists "_partitions" ('
+                    '"relname" varchar primary key, '
+                    '"partitioning" blob not null'
+                    ') ')
 
     def add_reltype(self, name, header):
+        self._invalidate_statements(name)
         c = self.con.cursor()
         columns = ', '.join('"{}" blob'.format(n) for n in header)
         c.execute('create table "{}" ({})'.format(name, columns))
@@ -519,64 +2650,248 @@ class _dumb_sqlite_connection:
             c.execute('insert into "_reldefs" ("relname", "attrname", "attrtype") '
                         'values (?, ?, ?)', (name, n, _pickle.dumps(t)))
 
-    def update_relation(self, name, val):
-        c = self.con.cursor()
-        c.execute('delete from "{}"'.format(name))
-        names = sorted(val.header.keys())
-        for rw in val:
-            c.execute('insert into "{}" ({}) values ({})'.format(
-                            name,
-                            ' ,'.join('"{}"'.format(n) for n in names),
-                            ' ,'.join(['?'] * len(names))), 
-                      [_pickle.dumps(getattr(rw, n)) for n in names])
-
-    def insert_row(self, name, rw):
-        c = self.con.cursor()
-        names = sorted(rw._header_.keys())
-        c.execute('insert into "{}" ({}) values ({})'.format(
-            name,
-            ' ,'.join('"{}"'.format(n) for n in names),
-            ' ,'.join(['?'] * len(names))),
-            [_pickle.dumps(getattr(rw, n)) for n in names])
-
-    def _namebits_and_values(self, d):
-        return zip(*[('"{}"=?'.format(n), v) for n, v in d.items()])
-
-    def _build_where(self, d):
-        namebits, where_values = self._namebits_and_values(d)
-        wherestr = ' and '.join(namebits)
-        return wherestr, where_values
-
-    def update_row(self, name, key_fields, changes):
-        c = self.con.cursor()
-        wherestr, where_values = self._build_where(key_fields)
-        namebits, set_values = self._namebits_and_values(changes)
-        setstr = ', '.join(namebits)
-        c.execute('update "{}" set {} where {}'.format(name, setstr, wherestr),
-                        [_pickle.dumps(v) for v in set_values + where_values])
+    def insert_rows(self, name, names, rows):
+        c, sql, params = self._statement(name, 'insert', names)
+        if self.metrics is None:
+            c.executemany(sql, map(params, rows))
+        else:
+            self._timed_write(name, 'insert', c, sql, params, rows)
 
-    def delete_row(self, name, key_fields, rw):
-        c = self.con.cursor()
-        wherestr, where_values = self._build_where(key_fields)
-        c.execute('delete from {} where {}'.format(name, wherestr),
-                        [_pickle.dumps(v) for v in where_values])
+    def delete_rows(self, name, key, rows):
+        c, sql, params = self._statement(name, 'delete', key)
+        if self.metrics is None:
+            c.executemany(sql, map(params, rows))
+        else:
+            self._timed_write(name, 'delete', c, sql, params, rows)
+
+    def _timed_write(self, name, op, c, sql, params, rows):
+        # The rows are pickled before executing the statement, rather than as
+        # it runs, so that the two can be timed separately.
+        start = _time.perf_counter()
+        values = list(map(params, rows))
+        pickled = _time.perf_counter()
+        c.executemany(sql, values)
+        done = _time.perf_counter()
+        if not values:
+            return
+        self.metrics.timing('pickle_encode', pickled - start, name)
+        self.metrics.timing(op, done - pickled, name)
+        self.metrics.count('rows_written', len(values), name)
 
-    def relations(self):
+    def headers(self):
         c = self.con.cursor()
         c.execute('select "relname", "attrname", "attrtype" from "_reldefs"')
         headers = _collections.defaultdict(dict)
         for relname, attrname, attrtype in c:
             headers[relname][attrname] = _pickle.loads(attrtype)
-        rels = []
-        for relname, header in headers.items():
-            r = _rel(**header)()
-            c.execute('select * from "{}"'.format(relname))
+        return headers
+
+    def rowid_ranges(self, relname, size):
+        # Split the rows into (first rowid, last rowid) ranges of size rows
+        # each (the last may have fewer).  Deletes leave gaps in the rowids,
+        # so the ranges are found from the rowids the rows actually have.
+        c = self.con.cursor()
+        c.execute('select rowid from "{}" order by rowid'.format(relname))
+        ranges = []
+        lo = last = None
+        for i, (rowid,) in enumerate(c):
+            if i % size == 0:
+                if lo is not None:
+                    ranges.append((lo, last))
+                lo = rowid
+            last = rowid
+        if lo is not None:
+            ranges.append((lo, last))
+        return ranges
+
+    def count(self, relname):
+        c = self.con.cursor()
+        c.execute('select count(*) from "{}"'.format(relname))
+        return c.fetchone()[0]
+
+    def header(self, relname):
+        c = self.con.cursor()
+        c.execute('select "attrname", "attrtype" from "_reldefs" '
+                      'where "relname"=?', (relname,))
+        return {attrname: _pickle.loads(attrtype) for attrname, attrtype in c}
+
+    def relation(self, relname, header=None):
+        # If header is given, only its attributes are loaded.
+        if header is None:
+            return self._load(relname, self.header(relname))
+        return self._load(relname, header, ', '.join(
+                                            '"{}"'.format(n) for n in header))
+
+    def _load(self, relname, header, columns='*'):
+        r = _rel(**header)()
+        r._rows.update(self.rows(relname, header, columns))
+        return r
+
+    def rows(self, relname, header, columns='*'):
+        # The values were validated when they were stored, so the rows are
+        # built without checking them again.
+        c = self.con.cursor()
+        row = _rel(**header).row
+        if self.metrics is not None:
+            yield from self._timed_rows(c, relname, row, columns)
+            return
+        c.execute('select {} from "{}"'.format(columns, relname))
+        names = [t[0] for t in c.description]
+        decoded = [_Decoded() for n in names]
+        getitem = _operator.getitem
+        for rwdata in c:
+            yield _trusted_row(row,
+                               dict(zip(names, map(getitem, decoded, rwdata))))
+
+    def rows_after(self, relname, header, after, limit):
+        # Up to limit rows whose rowid is greater than after, in rowid order,
+        # and the rowid of the last one.
+        c = self.con.cursor()
+        row = _rel(**header).row
+        start = _time.perf_counter()
+        c.execute('select rowid, {} from "{}" where rowid > ? '
+                      'order by rowid limit ?'.format(
+                        ', '.join('"{}"'.format(n) for n in header), relname),
+                  (after, limit))
+        names = [t[0] for t in c.description[1:]]
+        batch = c.fetchall()
+        decoding = _time.perf_counter()
+        decoded = [_Decoded() for n in names]
+        getitem = _operator.getitem
+        rows = [_trusted_row(row, dict(zip(names, map(getitem, decoded,
+                                                      rwdata[1:]))))
+                for rwdata in batch]
+        if self.metrics is not None and rows:
+            self.metrics.timing('select', decoding - start, relname)
+            self.metrics.timing('pickle_decode',
+                                _time.perf_counter() - decoding, relname)
+            self.metrics.count('rows_read', len(rows), relname)
+        return (batch[-1][0] if batch else after), rows
+
+    def _timed_rows(self, c, relname, row, columns):
+        # rows, reading in batches so that the reading and the decoding can
+        # be timed without timing whatever our caller does with the rows.
+        read = decode = 0.0
+        count = 0
+        try:
+            start = _time.perf_counter()
+            c.execute('select {} from "{}"'.format(columns, relname))
             names = [t[0] for t in c.description]
-            for rwdata in c:
-                r._rows.add(r.row({n: _pickle.loads(v)
-                                    for n, v in zip(names, rwdata)}))
-            rels.append((relname, r))
-        return rels
+            decoded = [_Decoded() for n in names]
+            getitem = _operator.getitem
+            while True:
+                batch = c.fetchmany(1000)
+                decoding = _time.perf_counter()
+                rows = [_trusted_row(row, dict(zip(names, map(getitem, decoded,
+                                                               rwdata))))
+                        for rwdata in batch]
+                read += decoding - start
+                decode += _time.perf_counter() - decoding
+                count += len(rows)
+                if not rows:
+                    break
+                yield from rows
+                start = _time.perf_counter()
+        finally:
+            self.metrics.timing('select', read, relname)
+            if count:
+                self.metrics.timing('pickle_decode', decode, relname)
+                self.metrics.count('rows_read', count, relname)
+
+    def get_versions(self, relnames=None):
+        c = self.con.cursor()
+        if relnames is None:
+            c.execute('select "relname", "version" from "_relversions"')
+        else:
+            relnames = list(relnames)
+            c.execute('select "relname", "version" from "_relversions" '
+                          'where "relname" in ({})'.format(
+                            ', '.join('?'*len(relnames))), relnames)
+        return dict(c)
+
+    def log_changes(self, deltas):
+        # Rows are logged as dicts, since row classes can't be pickled.
+        changes = {relname: ([vars(rw) for rw in ins],
+                             [vars(rw) for rw in dels])
+                   for relname, (ins, dels) in deltas.items() if ins or dels}
+        if changes:
+            self.con.execute('insert into "_changelog" ("changes") values (?)',
+                             (_pickle.dumps(changes),))
+
+    def get_changes(self, since, limit):
+        c = self.con.cursor()
+        c.execute('select "seq", "changes" from "_changelog" '
+                      'where "seq" > ? order by "seq" limit ?', (since, limit))
+        return [(seq, _pickle.loads(changes)) for seq, changes in c]
+
+    def discard_changes(self, upto):
+        self.con.execute('delete from "_changelog" where "seq" <= ?', (upto,))
+
+    def set_versions(self, versions):
+        c = self.con.cursor()
+        start = _time.perf_counter()
+        c.executemany('insert or replace into "_relversions" '
+                          '("relname", "version") values (?, ?)',
+                      versions.items())
+        if self.metrics is not None:
+            self.metrics.timing('update', _time.perf_counter() - start)
+
+    def set_key(self, relname, keynames):
+        # The key is backed by a unique index, which also lets the keyed
+        # deletes find their rows without scanning the table.
+        c = self.con.cursor()
+        c.execute('drop index if exists "{}__key"'.format(relname))
+        c.execute('delete from "_keys" where "relname"=?', (relname,))
+        c.execute('create unique index "{0}__key" on "{0}" ({1})'.format(
+                        relname,
+                        ', '.join('"{}"'.format(n) for n in keynames)))
+        c.executemany('insert into "_keys" ("relname", "attrname") '
+                          'values (?, ?)',
+                      [(relname, n) for n in keynames])
+
+    def get_keys(self):
+        keys = _collections.defaultdict(set)
+        c = self.con.cursor()
+        c.execute('select "relname", "attrname" from "_keys"')
+        for relname, attrname in c:
+            keys[relname].add(attrname)
+        return keys
+
+    def create_index(self, relname, indexname, attrnames):
+        c = self.con.cursor()
+        c.execute('create index "{}__{}" on "{}" ({})'.format(
+                        relname, indexname, relname,
+                        ', '.join('"{}"'.format(n) for n in attrnames)))
+        c.executemany('insert into "_indexes" '
+                          '("relname", "indexname", "attrname") '
+                          'values (?, ?, ?)',
+                      [(relname, indexname, n) for n in attrnames])
+
+    def drop_index(self, relname, indexname):
+        c = self.con.cursor()
+        c.execute('drop index "{}__{}"'.format(relname, indexname))
+        c.execute('delete from "_indexes" '
+                      'where "relname"=? and "indexname"=?',
+                  (relname, indexname))
+
+    def get_indexes(self):
+        indexes = _collections.defaultdict(dict)
+        c = self.con.cursor()
+        c.execute('select "relname", "indexname", "attrname" from "_indexes"')
+        for relname, indexname, attrname in c:
+            indexes[relname].setdefault(indexname, set()).add(attrname)
+        return indexes
+
+    def add_partitioning(self, relname, partitioning):
+        c = self.con.cursor()
+        c.execute('insert into "_partitions" ("relname", "partitioning") '
+                      'values (?, ?)',
+                  (relname, _pickle.dumps(partitioning)))
+
+    def get_partitionings(self):
+        c = self.con.cursor()
+        c.execute('select "relname", "partitioning" from "_partitions"')
+        return {relname: _pickle.loads(p) for relname, p in c}
 
     def get_row_constraints(self):
         constraints = _collections.defaultdict(dict)
@@ -0,0 +1,266 @@
+#Copyright 2012, 2013 R. David Murray (see end comment for terms).
+"""Streaming import and export of rows as CSV and JSON lines.
+
+The readers turn a file into a dinsd.external.Stream of rows of a given
+relation type, reading, converting, and validating the lines a batch at a time
+rather than holding the whole file in memory.  A Stream can be fed to the
+operators in dinsd.external, turned into a relation with its relation method,
+or loaded into a database relation with Database.load.  The writers write
+the rows of a relation (or of any iterable with a header) as they come,
+without sorting them.
+
+Each CSV value is converted by calling the type of its attribute (so '85' for
+an int attribute becomes 85), except that bool attributes accept true/false,
+yes/no, and 1/0 in any case.  A JSON value must already be of the type of its
+attribute (or, for an attribute whose type is a subclass of a JSON type, of
+that JSON type), except that an int is accepted (and converted) for a float
+attribute: 1.9 is not silently truncated to an int, nor null turned into the
+str 'None'.  A converters dict, mapping attribute names to functions of the
+text (for CSV) or decoded JSON value, overrides the default conversion for
+those attributes.  A value that can't be converted raises a ValueError giving
+the line it is on.
+
+Files are given as paths, or as open text files (opened with newline='' for
+CSV).
+
+"""
+
+import contextlib as _contextlib
+import csv as _csv
+import json as _json
+import os as _os
+from dinsd.external import Stream as _Stream
+
+# The number of lines read and converted at a time.
+batch_size = 10000
+
+_true = {'true', 'yes', '1', 't', 'y'}
+_false = {'false', 'no', '0', 'f', 'n'}
+
+
+def _bool(value):
+    if isinstance(value, bool):
+        return value
+    v = str(value).strip().lower()
+    if v in _true:
+        return True
+    if v in _false:
+        return False
+    raise ValueError("{!r} is not a bool".format(value))
+
+
+@_contextlib.contextmanager
+def _opened(f, mode, **kw):
+    if isinstance(f, (str, bytes, _os.PathLike)):
+        with open(f, mode, encoding='utf-8', **kw) as fp:
+            yield fp
+    else:
+        yield f
+
+
+# The types of the values JSON decodes to, bool before int since it is a
+# subclass of it.
+_json_types = (bool, int, float, str)
+
+
+def _exactly(t):
+    # The default conversion of JSON values for an attribute of type t.  A
+    # subclass of a JSON type (a str subclass used as an ID type, say) is
+    # built from a value of that JSON type.
+    base = next((j for j in _json_types if issubclass(t, j)), None)
+    def check(value):
+        if type(value) is t:
+            return value
+        if type(value) is base or base is float and type(value) is int:
+            return t(value)
+        raise TypeError("expected {}, not {}".format(t.__name__,
+                                                     type(value).__name__))
+    return check
+
+
+def _rowbuilder(rtype, names, converters, fname, coerce=True):
+    # Return a function that turns a batch, a list of (line number, values in
+    # names order) pairs, into rows.  Values are converted by calling the
+    # types of their attributes if coerce is true, and otherwise must be of
+    # those types already.
+    header = rtype.header
+    unknown = set(names) - header.keys()
+    if unknown:
+        raise ValueError("{}: unknown attributes {}".format(fname,
+                                                            sorted(unknown)))
+    missing = header.keys() - set(names)
+    if missing:
+        raise ValueError("{}: missing attributes {}".format(fname,
+                                                            sorted(missing)))
+    converters = converters or {}
+    # (name, converter, type of the values that need no conversion) for each
+    # column.
+    columns = []
+    for n in names:
+        conv = converters.get(n)
+        if conv is None:
+            t = header[n]
+            if not coerce:
+                conv = _exactly(t)
+            elif t is bool:
+                conv = _bool
+            else:
+                conv = t
+            columns.append((n, conv, t))
+        else:
+            columns.append((n, conv, None))
+    # The converted values only need to be checked if a converter other than
+    # the type itself might have produced them.
+    trusted = not converters
+    rowtype = rtype.row
+    def build(batch):
+        rows = []
+        for lineno, values in batch:
+            try:
+                attrs = {n: v if type(v) is t else conv(v)
+                         for (n, conv, t), v in zip(columns, values)}
+                if trusted:
+                    rw = rowtype.__new__(rowtype)
+                    rw.__dict__ = attrs
+                else:
+                    rw = rowtype(attrs)
+            except (TypeError, ValueError) as e:
+                raise ValueError("{}, line {}: {}".format(
+                    fname, lineno, _failure(columns, values, e))) from None
+            rows.append(rw)
+        return rows
+    return build
+
+
+def _failure(columns, values, error):
+    # Say which value could not be converted, if it was one of them.
+    for (n, conv, t), v in zip(columns, values):
+        try:
+            conv(v)
+        except (TypeError, ValueError) as e:
+            return "{!r} invalid for attribute {}: {}".format(v, n, e)
+    return error
+
+
+def _batches(lines):
+    batch = []
+    for item in lines:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def read_csv(f, rtype, fieldnames=None, converters=None, **fmtparams):
+    """Return a Stream of the rows of type rtype.row in the CSV file f.
+
+    The first line names the attributes, in any order, unless the names are
+    given as fieldnames.  fmtparams are passed to csv.reader.  Rows that
+    appear more than once in the file appear more than once in the Stream.
+    """
+    fname = getattr(f, 'name', f)
+    def rows():
+        with _opened(f, 'r', newline='') as fp:
+            reader = _csv.reader(fp, **fmtparams)
+            names = fieldnames
+            if names is None:
+                names = next(reader, None)
+                if names is None:
+                    return
+            build = _rowbuilder(rtype, list(names), converters, fname)
+            degree = len(names)
+            def lines():
+                for values in reader:
+                    if len(values) != degree:
+                        if not values:
+                            continue
+                        raise ValueError(
+                            "{}, line {}: expected {} values, got {}".format(
+                                fname, reader.line_num, degree, len(values)))
+                    yield reader.line_num, values
+            for batch in _batches(lines()):
+                yield from build(batch)
+    return _Stream(rtype.header, rows())
+
+
+def read_jsonl(f, rtype, converters=None):
+    """Return a Stream of the rows of type rtype.row in the JSON lines file f.
+
+    Each non-blank line is a JSON object mapping the attribute names to their
+    values, which must be of the attributes' types unless there is a
+    converter for them.
+    """
+    fname = getattr(f, 'name', f)
+    names = sorted(rtype.header)
+    build = _rowbuilder(rtype, names, converters, fname, coerce=False)
+    def lines(fp):
+        for lineno, line in enumerate(fp, start=1):
+            if not line.strip():
+                continue
+            try:
+                obj = _json.loads(line)
+                if len(obj) != len(names):
+                    raise KeyError(sorted(obj.keys() ^ set(names)))
+                values = [obj[n] for n in names]
+            except (ValueError, KeyError, AttributeError, TypeError) as e:
+                raise ValueError("{}, line {}: bad object: {}".format(
+                                    fname, lineno, e)) from None
+            yield lineno, values
+    def rows():
+        with _opened(f, 'r') as fp:
+            for batch in _batches(lines(fp)):
+                yield from build(batch)
+    return _Stream(rtype.header, rows())
+
+
+def write_csv(source, f, attrnames=None, header=True, **fmtparams):
+    """Write the rows of source to f as CSV, and return how many there were.
+
+    The columns are attrnames (by default all the attributes, sorted by name),
+    preceded by a line naming them if header is true.  Values are written as
+    their str.
+    """
+    names = sorted(source.header) if attrnames is None else list(attrnames)
+    count = 0
+    with _opened(f, 'w', newline='') as fp:
+        writer = _csv.writer(fp, **fmtparams)
+        if header:
+            writer.writerow(names)
+        for rw in source:
+            writer.writerow([getattr(rw, n) for n in names])
+            count += 1
+    return count
+
+
+def write_jsonl(source, f, attrnames=None, default=str):
+    """Write the rows of source to f as JSON lines, and return how many there
+    were.
+
+    default is called to turn values that JSON can't represent into ones it
+    can, as for json.dumps.
+    """
+    names = sorted(source.header) if attrnames is None else list(attrnames)
+    encoder = _json.JSONEncoder(default=default, sort_keys=True)
+    count = 0
+    with _opened(f, 'w') as fp:
+        for rw in source:
+            fp.write(encoder.encode({n: getattr(rw, n) for n in names}))
+            fp.write('\n')
+            count += 1
+    return count
+
+
+
+#Licensed under the Apache License, Version 2.0 (the "License");
+#you may not use this file except in compliance with the License.
+#You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+#Unless required by applicable law or agreed to in writing, software
+#distributed under the License is distributed on an "AS IS" BASIS,
+#WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#See the License for the specific language governing permissions and
+#limitations under the License.